@@ -0,0 +1,73 @@
+import os
+import time
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+from fastapi import Request
+
+
+class TTLCache:
+    """In-process cache of computed values with a TTL and single-flight misses
+
+    Concurrent misses for the same key share one computation instead of each
+    running their own. invalidate() drops every entry and bumps a generation
+    counter, so a computation that was already running when a write happened
+    is still returned to its waiters but never stored.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 64):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: Dict[str, tuple] = {}  # key -> (expires_at, value)
+        self._inflight: Dict[str, tuple] = {}  # key -> (generation, task)
+        self._generation = 0
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        inflight = self._inflight.get(key)
+        if inflight is None or inflight[0] != self._generation:
+            generation = self._generation
+            task = asyncio.ensure_future(compute())
+            self._inflight[key] = (generation, task)
+            task.add_done_callback(lambda done: self._finish(key, generation, done))
+        else:
+            task = inflight[1]
+        # Shielded so one cancelled request doesn't cancel the computation for the others
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, generation: int, task: asyncio.Future) -> None:
+        inflight = self._inflight.get(key)
+        if inflight is not None and inflight[1] is task:
+            del self._inflight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        if generation == self._generation and self.ttl > 0:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl, task.result())
+            while len(self._entries) > self.maxsize:
+                # Oldest insertion first
+                del self._entries[next(iter(self._entries))]
+
+    def invalidate(self) -> None:
+        self._generation += 1
+        self._entries.clear()
+
+
+# Computed /dashboard context; DASHBOARD_CACHE_TTL=0 disables caching
+dashboard_cache = TTLCache(ttl=float(os.getenv("DASHBOARD_CACHE_TTL", "60")))
+
+
+async def invalidate_dashboard_on_write(request: Request):
+    """Router dependency: drop the dashboard cache around every non-GET request
+
+    Invalidating both before and after the handler means a dashboard computed
+    while the write was in flight is not kept either.
+    """
+    is_write = request.method not in ("GET", "HEAD", "OPTIONS")
+    if is_write:
+        dashboard_cache.invalidate()
+    yield
+    if is_write:
+        dashboard_cache.invalidate()
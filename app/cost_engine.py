@@ -0,0 +1,206 @@
+from typing import Dict, Any, Optional, Iterable, Union, AsyncIterator
+from app import schemas
+from app.firestore_models import document_to_dict
+from app.fx_rates import get_exchange_rates
+
+
+def _date_str(value) -> str:
+    return value.strftime('%Y-%m-%d') if hasattr(value, 'strftime') else str(value)
+
+
+def rate_pairs(purchases: Iterable[Optional[Dict[str, Any]]]) -> list:
+    """(currency, purchase_date) pairs that need a TRY conversion"""
+    return [
+        (purchase.get("currency"), purchase.get("purchase_date"))
+        for purchase in purchases
+        if purchase and purchase.get("currency") != "TRY" and purchase.get("purchase_date")
+    ]
+
+
+def build_cost_estimate(
+    product: Dict[str, Any],
+    bom_lines: list,
+    purchases: Dict[str, Optional[Dict[str, Any]]],
+    materials: Dict[str, Optional[Dict[str, Any]]],
+    rates: Dict[tuple, tuple]
+) -> schemas.CostEstimate:
+    """Compute a product's cost estimate in a single pass over its BOM
+
+    All inputs are already resolved: purchases and materials by id, and rates
+    keyed by (currency, 'YYYY-MM-DD') as returned by get_exchange_rates().
+    material_breakdown, currency_totals and exchange_rates all come from the
+    same purchase and rate data, so nothing is read or fetched twice.
+    """
+    material_breakdown = []
+    currency_totals_dict = {}  # Dictionary to track totals per currency
+    exchange_rates = {}  # (currency, date) -> ExchangeRateInfo, in first-use order
+    has_missing_costs = False
+    total_try = 0.0
+
+    for bom_line in bom_lines:
+        # Get purchase specified in the BOM line
+        purchase = purchases.get(bom_line.get("purchase_id"))
+
+        if purchase:
+            unit_cost = purchase.get("unit_cost")
+            currency = purchase.get("currency")
+            total_cost_for_line = bom_line.get("qty_required", 0) * unit_cost
+
+            # Calculate total cost in TRY based on purchase date
+            total_cost_try = None
+            if currency == "TRY":
+                total_cost_try = total_cost_for_line
+            else:
+                purchase_date = purchase.get("purchase_date")
+                if purchase_date:
+                    rate_key = (currency, _date_str(purchase_date))
+                    rate, is_from_api = rates[rate_key]
+                    total_cost_try = total_cost_for_line * rate
+                    if rate_key not in exchange_rates:
+                        exchange_rates[rate_key] = schemas.ExchangeRateInfo(
+                            from_currency=currency,
+                            to_currency="TRY",
+                            rate=rate,
+                            date=rate_key[1],
+                            is_from_api=is_from_api
+                        )
+
+            # Add to currency total
+            currency_totals_dict[currency] = currency_totals_dict.get(currency, 0.0) + total_cost_for_line
+
+            has_cost = True
+            warning = None
+        else:
+            unit_cost = None
+            total_cost_for_line = None
+            total_cost_try = None
+            currency = None
+            has_cost = False
+            has_missing_costs = True
+            warning = "No purchase specified for this material"
+
+        # Sum up TRY costs (each material uses its own purchase date for conversion)
+        if total_cost_try is not None:
+            total_try += total_cost_try
+
+        # Get material name
+        material_id = bom_line.get("material_id")
+        material = materials.get(material_id)
+        material_name = material.get("name", "Unknown") if material else "Unknown"
+
+        material_breakdown.append(
+            schemas.MaterialCostBreakdown(
+                material_id=material_id,
+                material_name=material_name,
+                qty_required=bom_line.get("qty_required", 0),
+                unit=bom_line.get("unit", ""),
+                unit_cost=unit_cost,
+                currency=currency,
+                total_cost=total_cost_for_line,
+                total_cost_try=total_cost_try,
+                has_cost=has_cost,
+                warning=warning
+            )
+        )
+
+    # Convert currency totals dictionary to list
+    currency_totals = [
+        schemas.CurrencyTotal(currency=curr, total=total)
+        for curr, total in sorted(currency_totals_dict.items())
+    ]
+
+    return schemas.CostEstimate(
+        product_id=product["id"],
+        product_name=product.get("name", "Unknown"),
+        material_breakdown=material_breakdown,
+        currency_totals=currency_totals,
+        total_try=total_try if total_try > 0 else None,
+        exchange_rates=list(exchange_rates.values()),
+        has_missing_costs=has_missing_costs
+    )
+
+
+async def load_bom_lines(db, product_id: str) -> list:
+    """Load a product's BOM lines with the async Firestore client"""
+    bom_lines = []
+    async for bom_doc in db.collection("product_bom").where("product_id", "==", product_id).stream():
+        bom = document_to_dict(bom_doc)
+        if bom:
+            bom_lines.append(bom)
+    return bom_lines
+
+
+async def estimate_product_cost(product: Dict[str, Any], bom_lines: list, loader) -> schemas.CostEstimate:
+    """Resolve a BOM's purchases, materials and rates once, then build the estimate
+
+    Purchases and materials come from one batched read through the
+    AsyncDocumentLoader; each unique (currency, date) rate is resolved once,
+    concurrently.
+    """
+    loader.prime("purchases", (bom.get("purchase_id") for bom in bom_lines))
+    loader.prime("materials", (bom.get("material_id") for bom in bom_lines))
+    await loader.flush()
+    purchases = await loader.load_many("purchases", (bom.get("purchase_id") for bom in bom_lines))
+    materials = await loader.load_many("materials", (bom.get("material_id") for bom in bom_lines))
+
+    rates = await get_exchange_rates(rate_pairs(purchases.values()))
+    return build_cost_estimate(product, bom_lines, purchases, materials, rates)
+
+
+# Firestore caps the number of values in an "in" filter
+_IN_QUERY_LIMIT = 30
+
+
+async def estimate_catalog_costs(db, loader, product_ids: Union[list, str] = "all") -> AsyncIterator[Union[schemas.CostEstimate, Dict[str, Any]]]:
+    """Yield cost estimates for many products with bulk reads
+
+    Products, BOM lines, purchases and materials are each loaded in bulk (one
+    stream or batched get per collection instead of per product), and every
+    unique (currency, date) rate across the whole batch is resolved once.
+    Unknown product IDs yield {"product_id": ..., "error": ...} entries.
+    """
+    # Products
+    if product_ids == "all":
+        products = {}
+        async for doc in db.collection("products").stream():
+            product = document_to_dict(doc)
+            if product:
+                products[product["id"]] = product
+        order = list(products.keys())
+    else:
+        order = list(dict.fromkeys(product_ids))
+        products = {pid: p for pid, p in (await loader.load_many("products", order)).items() if p}
+
+    # BOM lines, grouped by product
+    bom_by_product: Dict[str, list] = {pid: [] for pid in products}
+    if product_ids == "all":
+        bom_queries = [db.collection("product_bom")]
+    else:
+        ids = list(products.keys())
+        bom_queries = [
+            db.collection("product_bom").where("product_id", "in", ids[i:i + _IN_QUERY_LIMIT])
+            for i in range(0, len(ids), _IN_QUERY_LIMIT)
+        ]
+    for query in bom_queries:
+        async for bom_doc in query.stream():
+            bom = document_to_dict(bom_doc)
+            if bom and bom.get("product_id") in bom_by_product:
+                bom_by_product[bom["product_id"]].append(bom)
+
+    # Purchases and materials for every BOM line in one batched read
+    all_lines = [bom for lines in bom_by_product.values() for bom in lines]
+    loader.prime("purchases", (bom.get("purchase_id") for bom in all_lines))
+    loader.prime("materials", (bom.get("material_id") for bom in all_lines))
+    await loader.flush()
+    purchases = await loader.load_many("purchases", (bom.get("purchase_id") for bom in all_lines))
+    materials = await loader.load_many("materials", (bom.get("material_id") for bom in all_lines))
+
+    # FX rates deduplicated across the whole batch
+    rates = await get_exchange_rates(rate_pairs(purchases.values()))
+
+    for product_id in order:
+        product = products.get(product_id)
+        if product is None:
+            yield {"product_id": product_id, "error": "Product not found"}
+            continue
+        yield build_cost_estimate(product, bom_by_product[product_id], purchases, materials, rates)
@@ -0,0 +1,112 @@
+import pandas as pd
+from typing import Dict, Any
+from app.firestore_models import document_to_dict
+from app.fx_rates import get_exchange_rates
+
+# Columns pulled from each collection into its DataFrame
+_COLUMNS = {
+    "products": ["id", "sku", "name", "count", "collection_name", "product_type"],
+    "product_bom": ["id", "product_id", "material_id", "purchase_id", "qty_required", "unit"],
+    "purchases": ["id", "material_id", "unit_cost", "currency", "purchase_date"],
+    "materials": ["id", "name", "type", "unit"],
+}
+
+
+async def _load_frame(db, collection: str) -> pd.DataFrame:
+    columns = _COLUMNS[collection]
+    rows = []
+    async for doc in db.collection(collection).stream():
+        data = document_to_dict(doc)
+        if data:
+            rows.append({column: data.get(column) for column in columns})
+    return pd.DataFrame(rows, columns=columns)
+
+
+async def load_cost_frames(db) -> Dict[str, pd.DataFrame]:
+    """Load products, BOM lines, purchases, materials and the FX table as DataFrames
+
+    The FX table holds one TRY rate per unique (currency, date) of the
+    purchases referenced by BOM lines, resolved through the persistent rate
+    store.
+    """
+    frames = {collection: await _load_frame(db, collection) for collection in _COLUMNS}
+
+    purchases = frames["purchases"]
+    # Same date key as get_exchange_rates() produces; a missing date becomes NaT, which has no usable strftime
+    purchases["date"] = purchases["purchase_date"].map(
+        lambda d: d.strftime('%Y-%m-%d') if pd.notna(d) and hasattr(d, 'strftime') else None
+    )
+
+    used = purchases[purchases["id"].isin(frames["product_bom"]["purchase_id"])]
+    needs_rate = used[(used["currency"] != "TRY") & used["purchase_date"].notna() & used["currency"].notna()]
+    rates = await get_exchange_rates(
+        (row.currency, row.purchase_date) for row in needs_rate.itertuples(index=False)
+    )
+    frames["fx"] = pd.DataFrame(
+        [(currency, date, rate, is_from_api) for (currency, date), (rate, is_from_api) in rates.items()],
+        columns=["currency", "date", "rate", "is_from_api"]
+    )
+    return frames
+
+
+def compute_catalog_costs(frames: Dict[str, pd.DataFrame]) -> Dict[str, pd.DataFrame]:
+    """Vectorized catalog costing: per-product TRY cost, per-currency totals and missing-cost flags
+
+    Returns {"products": one row per product, "currency_totals": one row per
+    (product, currency)}. Semantics match cost_engine.build_cost_estimate: a
+    line without a resolvable purchase flags the product as missing costs and
+    a non-TRY line without a purchase date has no TRY value.
+    """
+    bom = frames["product_bom"].rename(columns={"id": "bom_id"})
+    purchases = frames["purchases"][["id", "unit_cost", "currency", "date"]].rename(columns={"id": "purchase_id"})
+    products = frames["products"].rename(columns={"id": "product_id"})
+
+    lines = bom.merge(purchases, on="purchase_id", how="left")
+    lines["qty_required"] = pd.to_numeric(lines["qty_required"], errors="coerce").fillna(0.0)
+    lines["unit_cost"] = pd.to_numeric(lines["unit_cost"], errors="coerce")
+    lines["missing_cost"] = lines["unit_cost"].isna()
+    lines["line_cost"] = lines["qty_required"] * lines["unit_cost"]
+
+    lines = lines.merge(frames["fx"][["currency", "date", "rate"]], on=["currency", "date"], how="left")
+    lines.loc[lines["currency"] == "TRY", "rate"] = 1.0
+    lines["line_cost_try"] = lines["line_cost"] * lines["rate"]
+
+    per_product = lines.groupby("product_id").agg(
+        bom_lines=("bom_id", "size"),
+        total_try=("line_cost_try", lambda s: s.sum(min_count=1)),
+        has_missing_costs=("missing_cost", "any"),
+    )
+    report = products.merge(per_product, left_on="product_id", right_index=True, how="left")
+    report["bom_lines"] = report["bom_lines"].fillna(0).astype(int)
+    report["has_missing_costs"] = report["has_missing_costs"].fillna(False).astype(bool)
+    # Same convention as the single-product estimate: no positive TRY total -> None
+    report.loc[~(report["total_try"] > 0), "total_try"] = None
+
+    currency_totals = (
+        lines[~lines["missing_cost"]]
+        .groupby(["product_id", "currency"], as_index=False)["line_cost"].sum()
+        .rename(columns={"line_cost": "total"})
+    )
+    return {"products": report, "currency_totals": currency_totals}
+
+
+def catalog_cost_report(frames: Dict[str, pd.DataFrame]) -> list[Dict[str, Any]]:
+    """compute_catalog_costs() flattened into JSON-ready rows"""
+    costs = compute_catalog_costs(frames)
+    totals_by_product: Dict[str, Dict[str, float]] = {}
+    for row in costs["currency_totals"].itertuples(index=False):
+        totals_by_product.setdefault(row.product_id, {})[row.currency] = float(row.total)
+
+    report = costs["products"].astype(object).where(costs["products"].notna(), None)
+    rows = []
+    for row in report.to_dict(orient="records"):
+        rows.append({
+            "product_id": row["product_id"],
+            "sku": row["sku"],
+            "name": row["name"],
+            "bom_lines": int(row["bom_lines"]),
+            "total_try": float(row["total_try"]) if row["total_try"] is not None else None,
+            "currency_totals": totals_by_product.get(row["product_id"], {}),
+            "has_missing_costs": bool(row["has_missing_costs"]),
+        })
+    return rows
@@ -0,0 +1,90 @@
+import asyncio
+from typing import Iterable, Optional
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
+from fastapi import HTTPException
+from firebase_admin import firestore
+from app import schemas
+from app.firestore_models import document_to_dict
+from app.cost_engine import load_bom_lines, estimate_product_cost
+
+# One snapshot per product: product_costs/{product_id}
+SNAPSHOTS_COLLECTION = "product_costs"
+
+
+# Invalidation (called from the sync write paths)
+
+def mark_products_stale(db, product_ids: Iterable[Optional[str]]) -> None:
+    """Flag the cost snapshots of the given products for lazy recomputation"""
+    product_ids = {pid for pid in product_ids if pid}
+    if not product_ids:
+        return
+    try:
+        batch = db.batch()
+        for product_id in product_ids:
+            batch.set(
+                db.collection(SNAPSHOTS_COLLECTION).document(product_id),
+                {"stale": True, "stale_since": firestore.SERVER_TIMESTAMP},
+                merge=True
+            )
+        batch.commit()
+    except Exception as e:
+        print(f"⚠ Could not mark cost snapshots stale for {sorted(product_ids)}: {e}")
+
+
+def products_referencing(db, field: str, value: str) -> set:
+    """IDs of products with a BOM line whose `field` (purchase_id / material_id) equals value"""
+    bom_lines = db.collection("product_bom").where(field, "==", value).stream()
+    return {bom_line.to_dict().get("product_id") for bom_line in bom_lines}
+
+
+def delete_snapshot(db, product_id: str) -> None:
+    try:
+        db.collection(SNAPSHOTS_COLLECTION).document(product_id).delete()
+    except Exception as e:
+        print(f"⚠ Could not delete cost snapshot for {product_id}: {e}")
+
+
+# Lazy recomputation (async read path)
+
+async def get_product_cost(db, loader, product_id: str) -> schemas.CostEstimate:
+    """Return a product's cost estimate, recomputing its snapshot only when stale
+
+    A fresh snapshot is served as-is. Otherwise the estimate is rebuilt and
+    written back with a precondition on the snapshot's update time, so an
+    invalidation that lands mid-computation is never overwritten. Estimates
+    that relied on fallback FX rates are not cached.
+    """
+    snapshot_ref = db.collection(SNAPSHOTS_COLLECTION).document(product_id)
+    product_doc, snapshot = await asyncio.gather(
+        db.collection("products").document(product_id).get(),
+        snapshot_ref.get()
+    )
+    if not product_doc.exists:
+        raise HTTPException(status_code=404, detail="Product not found")
+
+    data = snapshot.to_dict() if snapshot.exists else None
+    if data and not data.get("stale") and data.get("estimate"):
+        return schemas.CostEstimate(**data["estimate"])
+
+    product = document_to_dict(product_doc)
+    bom_lines = await load_bom_lines(db, product_id)
+    estimate = await estimate_product_cost(product, bom_lines, loader)
+
+    if all(rate.is_from_api for rate in estimate.exchange_rates):
+        snapshot_data = {
+            "estimate": estimate.model_dump(),
+            "total_try": estimate.total_try,
+            "has_missing_costs": estimate.has_missing_costs,
+            "stale": False,
+            "computed_at": firestore.SERVER_TIMESTAMP
+        }
+        try:
+            if snapshot.exists:
+                await snapshot_ref.update(snapshot_data, option=db.write_option(last_update_time=snapshot.update_time))
+            else:
+                await snapshot_ref.create(snapshot_data)
+        except (AlreadyExists, FailedPrecondition, NotFound):
+            pass  # Invalidated or recomputed concurrently - the next read will rebuild it
+        except Exception as e:
+            print(f"⚠ Could not store cost snapshot for {product_id}: {e}")
+    return estimate
@@ -0,0 +1,81 @@
+from google.api_core.exceptions import NotFound, AlreadyExists
+from firebase_admin import firestore
+
+# Maintained document counts live in counters/{collection_name} as {"count": int}
+COUNTERS_COLLECTION = "counters"
+
+
+def increment_count(db, collection: str, amount: int = 1) -> None:
+    """Adjust the maintained count for a collection after a create (+n) or delete (-n)
+
+    Uses update() rather than set(merge=True) so a counter that was never seeded
+    stays missing - get_count() then seeds it from an aggregation query instead of
+    starting from a wrong baseline.
+    """
+    if not amount:
+        return
+    try:
+        db.collection(COUNTERS_COLLECTION).document(collection).update({"count": firestore.Increment(amount)})
+    except NotFound:
+        pass  # Not seeded yet - the next get_count() will count the collection
+    except Exception as e:
+        print(f"⚠ Could not update {collection} counter: {e}")
+
+
+def _aggregate_count(collection_ref) -> int:
+    try:
+        result = collection_ref.count().get()
+        return int(result[0][0].value)
+    except AttributeError:
+        # Client without aggregation query support
+        return sum(1 for _ in collection_ref.stream())
+
+
+async def _aggregate_count_async(collection_ref) -> int:
+    try:
+        result = await collection_ref.count().get()
+        return int(result[0][0].value)
+    except AttributeError:
+        count = 0
+        async for _ in collection_ref.stream():
+            count += 1
+        return count
+
+
+def get_count(db, collection: str) -> int:
+    """Return the number of documents in a collection with a single document read"""
+    counter_ref = db.collection(COUNTERS_COLLECTION).document(collection)
+    counter = counter_ref.get()
+    if counter.exists:
+        data = counter.to_dict() or {}
+        if "count" in data:
+            return max(int(data["count"]), 0)
+
+    # First use: seed the counter from a server-side count() aggregation
+    count = _aggregate_count(db.collection(collection))
+    try:
+        counter_ref.create({"count": count})
+    except AlreadyExists:
+        pass
+    except Exception as e:
+        print(f"⚠ Could not seed {collection} counter: {e}")
+    return count
+
+
+async def get_count_async(db, collection: str) -> int:
+    """get_count() for the async Firestore client"""
+    counter_ref = db.collection(COUNTERS_COLLECTION).document(collection)
+    counter = await counter_ref.get()
+    if counter.exists:
+        data = counter.to_dict() or {}
+        if "count" in data:
+            return max(int(data["count"]), 0)
+
+    count = await _aggregate_count_async(db.collection(collection))
+    try:
+        await counter_ref.create({"count": count})
+    except AlreadyExists:
+        pass
+    except Exception as e:
+        print(f"⚠ Could not seed {collection} counter: {e}")
+    return count
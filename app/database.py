@@ -1,7 +1,7 @@
 import os
 import firebase_admin
-from firebase_admin import credentials, firestore
-from typing import Generator
+from firebase_admin import credentials, firestore, firestore_async
+from typing import Generator, AsyncGenerator
 from dotenv import load_dotenv
 from fastapi import HTTPException
 
@@ -59,16 +59,34 @@ except Exception as e:
     traceback.print_exc()
     # Don't raise - let app start so we can see the error in logs
 
+# Get async Firestore client (used by async def handlers so RPCs don't block the event loop)
+async_db = None
+try:
+    async_db = firestore_async.client()
+    print(f"✓ Async Firestore client initialized")
+except Exception as e:
+    print(f"⚠ Async Firestore client initialization failed: {e}")
+    print("⚠ Async handlers will return 503 until this is fixed")
+
+def _database_unavailable() -> HTTPException:
+    error_detail = "Database not initialized. "
+    if os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
+        error_detail += f"Check that GOOGLE_APPLICATION_CREDENTIALS points to a valid file: {os.getenv('GOOGLE_APPLICATION_CREDENTIALS')}"
+    else:
+        error_detail += "GOOGLE_APPLICATION_CREDENTIALS environment variable is not set. Check your .env file or environment variables."
+    return HTTPException(
+        status_code=503, 
+        detail=error_detail
+    )
+
 def get_db() -> Generator:
     """Firestore client dependency (replaces SQLAlchemy session)"""
     if db is None:
-        error_detail = "Database not initialized. "
-        if os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
-            error_detail += f"Check that GOOGLE_APPLICATION_CREDENTIALS points to a valid file: {os.getenv('GOOGLE_APPLICATION_CREDENTIALS')}"
-        else:
-            error_detail += "GOOGLE_APPLICATION_CREDENTIALS environment variable is not set. Check your .env file or environment variables."
-        raise HTTPException(
-            status_code=503, 
-            detail=error_detail
-        )
+        raise _database_unavailable()
     yield db
+
+async def get_async_db() -> AsyncGenerator:
+    """Async Firestore client dependency for async def handlers"""
+    if async_db is None:
+        raise _database_unavailable()
+    yield async_db
@@ -0,0 +1,237 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional
+from firebase_admin import firestore
+from app import database
+from app.http_client import get_http_client
+
+
+class FxRateStore:
+    """Durable exchange rate store keyed by (base, target, date)
+
+    Historical rates never change, so once a rate for a past date has been
+    fetched from an API it is written to the Firestore `fx_rates` collection and
+    never requested again. An in-process LRU sits in front of Firestore so hot
+    rates cost no reads at all.
+
+    Rates that may still change - today's rate, or a hard-coded fallback used
+    because every API failed - are only kept in memory for a short TTL so they
+    are retried later instead of being persisted.
+    """
+
+    def __init__(self, collection: str = "fx_rates", maxsize: Optional[int] = None, provisional_ttl: Optional[float] = None):
+        self.collection = collection
+        self.maxsize = maxsize or int(os.getenv("FX_RATE_CACHE_SIZE", "4096"))
+        self.provisional_ttl = provisional_ttl if provisional_ttl is not None else float(os.getenv("FX_RATE_PROVISIONAL_TTL", "600"))
+        self._lru: OrderedDict = OrderedDict()  # key -> (rate, is_from_api, expires_at or None)
+
+    @staticmethod
+    def _key(base_currency: str, target_currency: str, date_str: str) -> str:
+        return f"{base_currency}_{target_currency}_{date_str}"
+
+    @staticmethod
+    def _is_final(date_str: str) -> bool:
+        """A rate is final once its date is in the past (UTC)"""
+        return date_str < datetime.now(timezone.utc).strftime('%Y-%m-%d')
+
+    def _remember(self, key: str, rate: float, is_from_api: bool, expires_at: Optional[float]) -> None:
+        self._lru[key] = (rate, is_from_api, expires_at)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.maxsize:
+            self._lru.popitem(last=False)
+
+    def get_cached(self, base_currency: str, target_currency: str, date_str: str) -> Optional[tuple[float, bool]]:
+        """Look up a rate in the in-process LRU only"""
+        key = self._key(base_currency, target_currency, date_str)
+        entry = self._lru.get(key)
+        if entry is None:
+            return None
+        rate, is_from_api, expires_at = entry
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._lru[key]
+            return None
+        self._lru.move_to_end(key)
+        return (rate, is_from_api)
+
+    async def get(self, base_currency: str, target_currency: str, date_str: str) -> Optional[tuple[float, bool]]:
+        """Return (rate, is_from_api) from the LRU or Firestore, or None if unknown"""
+        cached = self.get_cached(base_currency, target_currency, date_str)
+        if cached is not None:
+            return cached
+
+        if database.async_db is None:
+            return None
+        key = self._key(base_currency, target_currency, date_str)
+        try:
+            doc = await database.async_db.collection(self.collection).document(key).get()
+        except Exception as e:
+            print(f"⚠ Could not read stored FX rate {key}: {e}")
+            return None
+        if not doc.exists:
+            return None
+        data = doc.to_dict() or {}
+        if "rate" not in data:
+            return None
+        rate = float(data["rate"])
+        self._remember(key, rate, True, None)
+        return (rate, True)
+
+    async def put(self, base_currency: str, target_currency: str, date_str: str, rate: float, is_from_api: bool, source: Optional[str] = None) -> None:
+        """Record a rate; only final API rates are persisted"""
+        key = self._key(base_currency, target_currency, date_str)
+        if not (is_from_api and self._is_final(date_str)):
+            self._remember(key, rate, is_from_api, time.monotonic() + self.provisional_ttl)
+            return
+
+        self._remember(key, rate, True, None)
+        if database.async_db is None:
+            return
+        try:
+            await database.async_db.collection(self.collection).document(key).set({
+                "base_currency": base_currency,
+                "target_currency": target_currency,
+                "date": date_str,
+                "rate": rate,
+                "source": source,
+                "fetched_at": firestore.SERVER_TIMESTAMP
+            })
+        except Exception as e:
+            print(f"⚠ Could not persist FX rate {key}: {e}")
+
+
+rate_store = FxRateStore()
+
+# Lookups in progress, keyed like the store: concurrent misses for one rate share a single task
+_in_flight: dict = {}
+
+
+async def _resolve_exchange_rate(base_currency: str, target_currency: str, date_str: str) -> tuple[float, bool]:
+    stored = await rate_store.get(base_currency, target_currency, date_str)
+    if stored is not None:
+        return stored
+    
+    rate, is_from_api, source = await fetch_exchange_rate(base_currency, target_currency, date_str)
+    await rate_store.put(base_currency, target_currency, date_str, rate, is_from_api, source)
+    return (rate, is_from_api)
+
+
+async def get_exchange_rate(base_currency: str, target_currency: str, date: datetime) -> tuple[float, bool]:
+    """
+    Get exchange rate for a given date.
+    Served from the persistent FX rate store when known; otherwise fetched
+    from the APIs once and recorded there. Concurrent callers missing the
+    same rate await one shared lookup instead of each hitting Firestore and
+    the APIs.
+    Returns: (rate, is_from_api) tuple
+    """
+    if base_currency == target_currency:
+        return (1.0, True)
+    
+    date_str = date.strftime('%Y-%m-%d')
+    
+    cached = rate_store.get_cached(base_currency, target_currency, date_str)
+    if cached is not None:
+        return cached
+    
+    key = (base_currency, target_currency, date_str)
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_resolve_exchange_rate(base_currency, target_currency, date_str))
+        _in_flight[key] = task
+        task.add_done_callback(lambda _: _in_flight.pop(key, None))
+    # shield: a caller that is cancelled must not cancel the lookup for the others
+    return await asyncio.shield(task)
+
+
+async def get_exchange_rates(pairs, target_currency: str = "TRY") -> dict:
+    """
+    Get exchange rates for several (currency, date) pairs concurrently.
+    Duplicate pairs are resolved once, and all misses hit the APIs in parallel.
+    Returns: {(currency, 'YYYY-MM-DD'): (rate, is_from_api)}
+    """
+    unique_pairs = {}
+    for currency, date in pairs:
+        unique_pairs.setdefault((currency, date.strftime('%Y-%m-%d')), (currency, date))
+    results = await asyncio.gather(*(
+        get_exchange_rate(currency, target_currency, date)
+        for currency, date in unique_pairs.values()
+    ))
+    return dict(zip(unique_pairs.keys(), results))
+
+
+async def fetch_exchange_rate(base_currency: str, target_currency: str, date_str: str) -> tuple[float, bool, str]:
+    """
+    Fetch exchange rate for a given date from the external APIs.
+    Uses Frankfurter API (https://api.frankfurter.dev) as primary source.
+    Returns: (rate, is_from_api, source) tuple
+    """
+    client = get_http_client()
+    
+    # Try Frankfurter API first (primary source)
+    # API: https://api.frankfurter.dev/v1/{date}?base={base}&symbols={target}
+    # Response: {"amount":1.0,"base":"USD","date":"2015-12-24","rates":{"EUR":0.91349,"TRY":2.9223}}
+    try:
+        url = f"https://api.frankfurter.dev/v1/{date_str}"
+        response = await client.get(url, params={
+            "base": base_currency,
+            "symbols": target_currency
+        })
+        if response.status_code == 200:
+            data = response.json()
+            if "rates" in data and target_currency in data["rates"]:
+                rate = float(data["rates"][target_currency])
+                print(f"✓ Fetched rate from Frankfurter API: 1 {base_currency} = {rate} {target_currency} (date: {date_str})")
+                return (rate, True, "frankfurter")
+    except Exception as e:
+        print(f"⚠ Frankfurter API failed: {e}")
+    
+    # Try exchangerate-api.com as backup
+    try:
+        url = f"https://api.exchangerate-api.com/v4/historical/{base_currency}/{date_str}"
+        response = await client.get(url)
+        if response.status_code == 200:
+            data = response.json()
+            if "rates" in data and target_currency in data["rates"]:
+                rate = float(data["rates"][target_currency])
+                print(f"✓ Fetched rate from exchangerate-api.com: 1 {base_currency} = {rate} {target_currency} (date: {date_str})")
+                return (rate, True, "exchangerate-api.com")
+    except Exception as e:
+        print(f"⚠ exchangerate-api.com failed: {e}")
+    
+    # Try exchangerate.host as backup
+    try:
+        url = f"https://api.exchangerate.host/{date_str}"
+        response = await client.get(url, params={
+            "base": base_currency,
+            "symbols": target_currency
+        })
+        if response.status_code == 200:
+            data = response.json()
+            if data.get("success") and "rates" in data:
+                rates = data["rates"]
+                if target_currency in rates:
+                    rate = float(rates[target_currency])
+                    print(f"✓ Fetched rate from exchangerate.host: 1 {base_currency} = {rate} {target_currency} (date: {date_str})")
+                    return (rate, True, "exchangerate.host")
+    except Exception as e:
+        print(f"⚠ exchangerate.host failed: {e}")
+    
+    # All APIs failed - use fallback
+    print(f"⚠ All APIs failed for {base_currency} to {target_currency} on {date_str}. Using fallback rate.")
+    default_rates = {
+        "USD": {"TRY": 30.0},
+        "EUR": {"TRY": 33.0},
+        "GBP": {"TRY": 38.0},
+        "JPY": {"TRY": 0.20},
+        "CNY": {"TRY": 4.2},
+        "INR": {"TRY": 0.36},
+        "CAD": {"TRY": 22.0},
+        "AUD": {"TRY": 20.0},
+        "CHF": {"TRY": 34.0},
+        "SGD": {"TRY": 22.0},
+    }
+    fallback_rate = default_rates.get(base_currency, {}).get(target_currency, 1.0)
+    return (fallback_rate, False, "fallback")
@@ -0,0 +1,40 @@
+import os
+import httpx
+from typing import Optional
+
+# App-lifetime pooled HTTP client (keep-alive connections are reused across requests)
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _build_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=float(os.getenv("HTTP_CLIENT_TIMEOUT", "10.0")),
+        limits=httpx.Limits(
+            max_connections=int(os.getenv("HTTP_CLIENT_MAX_CONNECTIONS", "50")),
+            max_keepalive_connections=int(os.getenv("HTTP_CLIENT_MAX_KEEPALIVE", "20")),
+        ),
+    )
+
+
+async def open_client() -> httpx.AsyncClient:
+    """Create the shared client (called from the FastAPI lifespan hook)"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _build_client()
+    return _client
+
+
+async def close_client() -> None:
+    """Close the shared client and its connection pool"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the shared client, creating it lazily if the lifespan hook hasn't run"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _build_client()
+    return _client
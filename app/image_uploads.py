@@ -0,0 +1,275 @@
+import os
+import asyncio
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists
+from app.storage import storage_client, UPLOAD_MAX_BYTES
+
+# Reference count per stored content hash: image_contents/{content_hash} = {"count": int}.
+# Taken before an upload may reuse existing blobs and dropped before they are deleted,
+# so an upload and a delete of the same content can't interleave into a dangling image.
+IMAGE_CONTENTS_COLLECTION = "image_contents"
+
+# Storage uploads are blocking calls; run them on a bounded pool instead of the event loop
+_upload_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("IMAGE_UPLOAD_CONCURRENCY", "4")),
+    thread_name_prefix="image-upload"
+)
+
+
+def next_image_order(db, product_id: str) -> int:
+    """Order value for the next image appended to a product's gallery"""
+    max_order = -1
+    for image_doc in db.collection("product_images").where("product_id", "==", product_id).stream():
+        image_data = image_doc.to_dict()
+        if image_data and "order" in image_data:
+            max_order = max(max_order, image_data["order"])
+    return max_order + 1
+
+
+@firestore.transactional
+def _adjust_content_refs(transaction, db, content_hash: str, delta: int) -> tuple:
+    """Add delta to a content hash's reference count; returns (count before, count after)"""
+    ref = db.collection(IMAGE_CONTENTS_COLLECTION).document(content_hash)
+    snapshot = ref.get(transaction=transaction)
+    if snapshot.exists:
+        before = int((snapshot.to_dict() or {}).get("count", 0))
+    else:
+        # Content stored before reference counting: seed from its documents
+        # (on release the caller's document is already deleted but still counts)
+        query = db.collection("product_images").where("content_hash", "==", content_hash)
+        before = sum(1 for _ in transaction.get(query)) + (1 if delta < 0 else 0)
+    after = max(before + delta, 0)
+    transaction.set(ref, {"count": after, "updated_at": firestore.SERVER_TIMESTAMP})
+    return before, after
+
+
+def claim_content(db, content_hash: str) -> bool:
+    """Take a reference on stored content; True if others already hold one, so its blobs can be reused"""
+    before, _ = _adjust_content_refs(db.transaction(), db, content_hash, 1)
+    return before > 0
+
+
+def drop_content(db, content_hash: str) -> bool:
+    """Drop a reference on stored content; True if it was the last one"""
+    _, after = _adjust_content_refs(db.transaction(), db, content_hash, -1)
+    return after == 0
+
+
+def _content_unused(db, content_hash: str) -> bool:
+    snapshot = db.collection(IMAGE_CONTENTS_COLLECTION).document(content_hash).get()
+    return not snapshot.exists or int((snapshot.to_dict() or {}).get("count", 0)) == 0
+
+
+def _release_content(db, content_hash: str, image_data: Dict[str, Any]) -> None:
+    if drop_content(db, content_hash):
+        storage_client.delete_image(image_data, still_unused=lambda: _content_unused(db, content_hash))
+
+
+def _result(filename: str, status: str, error: Optional[str] = None, **extra) -> Dict[str, Any]:
+    return {"filename": filename, "status": status, "error": error, **extra}
+
+
+def _record_uploads(db, product_id: str, pending: list, uploads: list, claimed: dict, results: list) -> None:
+    """Write the product_images documents for finished uploads in one batch (blocking)
+
+    Fills in results for every pending file; references taken on content
+    that ends up unrecorded are given back.
+    """
+    first_order = next_image_order(db, product_id)
+    batch = db.batch()
+    written = 0
+    recorded = []  # uploads in this batch, released again if it fails
+    for (idx, filename, _, _), upload in zip(pending, uploads):
+        if isinstance(upload, Exception) or not upload:
+            results[idx] = _result(filename, "failed", str(upload) if upload else "Upload failed")
+            if idx in claimed:
+                # Nothing was recorded; a partly written blob is rewritten by the next claim
+                drop_content(db, claimed[idx])
+            continue
+        doc_ref = db.collection("product_images").document()
+        batch.set(doc_ref, {
+            "product_id": product_id,
+            "image_url": upload["image_url"],
+            "content_hash": upload["content_hash"],
+            "variants": upload["variants"],
+            "order": first_order + written,
+            "created_at": firestore.SERVER_TIMESTAMP
+        })
+        written += 1
+        recorded.append(upload)
+        results[idx] = _result(
+            filename, "uploaded",
+            image_id=doc_ref.id, image_url=upload["image_url"], deduplicated=upload["deduplicated"]
+        )
+    if written:
+        try:
+            batch.commit()
+        except Exception:
+            for upload in recorded:
+                _release_content(db, upload["content_hash"], upload)
+            raise
+
+
+async def upload_product_images(db, product_id: str, image_files: list) -> list:
+    """Upload a product's images concurrently and record them in one batch
+
+    Files are uploaded straight from their spooled upload files in parallel
+    on the bounded upload pool, so a multi-image product takes about as long
+    as its slowest upload. Images are stored by content hash, so content
+    already in the bucket is not uploaded again; a reference on the content is
+    taken before that check (see IMAGE_CONTENTS_COLLECTION). Each image also
+    gets resized WebP derivatives, recorded as "variants" on its document.
+    The product_images documents for every successful upload are written in a
+    single batch, keeping the order the files were given in. All Firestore
+    work (reference counts, order lookup, commit) runs on the pool as well, so
+    the event loop never waits on a round trip.
+
+    Returns one result per file: {"filename", "status" (uploaded / skipped /
+    failed), "error", and "image_id"/"image_url"/"deduplicated" when uploaded}.
+    """
+    results = [None] * len(image_files)
+    pending = []  # (index, filename, file object, content_type)
+    for idx, image_file in enumerate(image_files):
+        filename = (image_file.filename or "").strip()
+        if not filename:
+            results[idx] = _result(filename, "skipped", "Empty filename")
+            continue
+        if not storage_client.bucket:
+            results[idx] = _result(filename, "skipped", "Firebase Storage not configured (set FIREBASE_STORAGE_BUCKET)")
+            continue
+        size = getattr(image_file, "size", None)
+        if size is not None and size > UPLOAD_MAX_BYTES:
+            results[idx] = _result(filename, "failed", f"File is larger than {UPLOAD_MAX_BYTES} bytes")
+            continue
+        try:
+            # Streamed from the spooled upload file; never read into memory here
+            image_file.file.seek(0)
+        except Exception as e:
+            results[idx] = _result(filename, "failed", f"Could not read file: {e}")
+            continue
+        pending.append((idx, filename, image_file.file, image_file.content_type or "image/jpeg"))
+
+    if pending:
+        loop = asyncio.get_running_loop()
+        claimed = {}  # idx -> content hash a reference was taken on
+
+        def claim_for(idx):
+            def claim(content_hash):
+                reusable = claim_content(db, content_hash)
+                claimed[idx] = content_hash
+                return reusable
+            return claim
+
+        uploads = await asyncio.gather(*(
+            loop.run_in_executor(
+                _upload_pool,
+                functools.partial(storage_client.upload_image, stream, filename, content_type, claim=claim_for(idx))
+            )
+            for idx, filename, stream, content_type in pending
+        ), return_exceptions=True)
+
+        # Order lookup, batch commit and reference releases are blocking Firestore calls too
+        await loop.run_in_executor(
+            _upload_pool, _record_uploads, db, product_id, pending, uploads, claimed, results
+        )
+
+    uploaded = [r["filename"] for r in results if r["status"] == "uploaded"]
+    failed = [r["filename"] for r in results if r["status"] != "uploaded"]
+    if uploaded:
+        print(f"✓ Uploaded {len(uploaded)} image(s) for product {product_id}: {', '.join(uploaded)}")
+    if failed:
+        print(f"⚠ {len(failed)} image(s) not uploaded for product {product_id}: {', '.join(failed)}")
+    return results
+
+
+def direct_upload_image_id(blob_name: str) -> str:
+    """product_images document id for a direct upload, derived from its blob so it is registered at most once"""
+    return "direct_" + hashlib.sha256(blob_name.encode("utf-8")).hexdigest()[:40]
+
+
+def _registered_image_ids(db, image_refs: list) -> set:
+    return {snapshot.id for snapshot in db.get_all(image_refs, field_paths=["product_id"]) if snapshot.exists}
+
+
+def register_direct_uploads(db, product_id: str, uploads: list) -> list:
+    """Record images a browser uploaded straight to the bucket via signed PUT URLs
+
+    Blocking (call from a sync handler). Each upload ({"blob_name",
+    "filename"}) is checked against the bucket's metadata in parallel on the
+    upload pool, then every accepted one is written to product_images in one
+    batch. Document ids are derived from the blob name, so finalizing the
+    same upload again (a retry, a double submit or a concurrent finalize)
+    reports it as skipped instead of registering a second image for one blob.
+    Returns one result per upload in the same shape as upload_product_images().
+    """
+    image_refs = [db.collection("product_images").document(direct_upload_image_id(u["blob_name"])) for u in uploads]
+    registered = _registered_image_ids(db, image_refs)
+
+    checks = {}  # doc id -> signed URL or the exception, first occurrence of each unregistered upload
+    futures = {}
+    for upload, doc_ref in zip(uploads, image_refs):
+        if doc_ref.id not in registered and doc_ref.id not in futures:
+            futures[doc_ref.id] = _upload_pool.submit(storage_client.finalize_upload, product_id, upload["blob_name"])
+    for doc_id, future in futures.items():
+        try:
+            checks[doc_id] = future.result()
+        except Exception as e:
+            checks[doc_id] = e
+
+    while True:
+        results = []
+        first_order = next_image_order(db, product_id)
+        batch = db.batch()
+        claimed = set()
+        for upload, doc_ref in zip(uploads, image_refs):
+            filename = upload.get("filename") or upload["blob_name"].rsplit("/", 1)[-1]
+            if doc_ref.id in registered or doc_ref.id in claimed:
+                results.append(_result(filename, "skipped", "Already registered", image_id=doc_ref.id))
+                continue
+            image_url = checks[doc_ref.id]
+            if isinstance(image_url, Exception):
+                results.append(_result(filename, "failed", str(image_url)))
+                continue
+            # create() fails the batch if a concurrent finalize registered the blob first
+            batch.create(doc_ref, {
+                "product_id": product_id,
+                "image_url": image_url,
+                "blob_name": upload["blob_name"],
+                "order": first_order + len(claimed),
+                "created_at": firestore.SERVER_TIMESTAMP
+            })
+            claimed.add(doc_ref.id)
+            results.append(_result(filename, "uploaded", image_id=doc_ref.id, image_url=image_url))
+        if not claimed:
+            return results
+        try:
+            batch.commit()
+            return results
+        except AlreadyExists:
+            # Nothing in the batch was written; drop what the other finalize registered and retry the rest
+            now_registered = _registered_image_ids(db, image_refs)
+            if not (now_registered - registered):
+                raise
+            registered = now_registered
+
+
+def release_image(db, image_data: Optional[Dict[str, Any]]) -> None:
+    """Remove an image's blobs once its product_images document has been deleted
+
+    Content-addressed images can be shared by several product_images
+    documents, so their blobs are only deleted when this drops the last
+    reference on the content_hash, and then only if no upload re-claimed it
+    in the meantime. Images uploaded before content addressing have no hash
+    and are always deleted.
+    """
+    if not image_data or not image_data.get("image_url"):
+        return
+    content_hash = image_data.get("content_hash")
+    if content_hash:
+        _release_content(db, content_hash, image_data)
+        return
+    storage_client.delete_image(image_data)
@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import BinaryIO, Dict, Optional
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow not installed - uploads keep only the original
+    Image = None
+    ImageOps = None
+
+# Derivatives created for every uploaded image: name -> target width in px
+# (thumb for the 80px gallery strip at 2x, medium for the 500px carousel at ~2x)
+VARIANT_WIDTHS = {"thumb": 160, "medium": 960}
+VARIANT_CONTENT_TYPE = "image/webp"
+VARIANT_EXTENSION = "webp"
+# Chunk size used when spilling an upload to disk for the worker process
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn, not fork: the parent process runs gRPC/HTTP threads
+        _pool = ProcessPoolExecutor(
+            max_workers=int(os.getenv("IMAGE_PROCESS_WORKERS", "2")),
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pool
+
+
+def shutdown() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def render_variants(source_path: str, widths: Dict[str, int]) -> Dict[str, tuple]:
+    """Resize the image at source_path to each width as WebP (runs in a worker process)
+
+    Returns {name: (webp bytes, width, height)}. Images narrower than a target
+    width are re-encoded at their own size rather than upscaled.
+    """
+    with Image.open(source_path) as original:
+        image = ImageOps.exif_transpose(original)
+        image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+        variants = {}
+        for name, width in widths.items():
+            if width < image.width:
+                height = max(1, round(image.height * width / image.width))
+                resized = image.resize((width, height), Image.LANCZOS)
+            else:
+                resized = image
+            output = BytesIO()
+            resized.save(output, format="WEBP", quality=80, method=4)
+            variants[name] = (output.getvalue(), resized.width, resized.height)
+        return variants
+
+
+def create_variants(source: BinaryIO) -> Dict[str, tuple]:
+    """render_variants() on the process pool; {} if Pillow is missing or the image can't be processed
+
+    The stream is copied in chunks from its current position to a temporary
+    file and only that path is sent to the worker, so the upload is never
+    held in memory here or pickled across the process boundary.
+    """
+    if Image is None:
+        return {}
+    path = None
+    try:
+        with tempfile.NamedTemporaryFile(prefix="image-variant-", delete=False) as spool:
+            path = spool.name
+            shutil.copyfileobj(source, spool, _COPY_CHUNK_SIZE)
+        future = _get_pool().submit(render_variants, path, VARIANT_WIDTHS)
+        return future.result(timeout=float(os.getenv("IMAGE_PROCESS_TIMEOUT", "60")))
+    except Exception as e:
+        print(f"⚠ Could not create image variants: {e}")
+        return {}
+    finally:
+        if path:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+def variant_url(image: Dict, min_width: int) -> str:
+    """Smallest recorded variant at least min_width wide, else the original image URL"""
+    candidates = [
+        variant for variant in (image.get("variants") or {}).values()
+        if variant.get("url") and variant.get("width", 0) >= min_width
+    ]
+    if candidates:
+        return min(candidates, key=lambda v: v["width"])["url"]
+    return image.get("image_url", "")
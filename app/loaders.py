@@ -0,0 +1,106 @@
+from typing import Dict, Any, Optional, Iterable
+from collections import defaultdict
+from fastapi import Depends
+from app.database import get_db, get_async_db
+from app.firestore_models import document_to_dict
+
+
+class _BaseDocumentLoader:
+    """Shared queue/cache bookkeeping for the sync and async loaders"""
+
+    def __init__(self, db):
+        self.db = db
+        self._cache: Dict[tuple, Optional[Dict[str, Any]]] = {}
+        self._pending: Dict[str, set] = defaultdict(set)
+
+    def prime(self, collection: str, ids: Iterable[Optional[str]]) -> None:
+        """Queue document IDs to be fetched on the next flush"""
+        for doc_id in ids:
+            if doc_id and (collection, doc_id) not in self._cache:
+                self._pending[collection].add(doc_id)
+
+    def _take_pending_refs(self) -> list:
+        refs = []
+        for collection, ids in self._pending.items():
+            for doc_id in ids:
+                refs.append(self.db.collection(collection).document(doc_id))
+                # Mark as missing until the batch says otherwise
+                self._cache[(collection, doc_id)] = None
+        self._pending.clear()
+        return refs
+
+    def _store(self, snapshot) -> None:
+        collection = snapshot.reference.parent.id
+        self._cache[(collection, snapshot.id)] = document_to_dict(snapshot)
+
+    def _cached(self, collection: str, ids: list) -> Dict[str, Optional[Dict[str, Any]]]:
+        return {doc_id: self._cache.get((collection, doc_id)) for doc_id in ids}
+
+
+class DocumentLoader(_BaseDocumentLoader):
+    """Request-scoped batching loader for Firestore documents (DataLoader pattern)
+
+    Handlers queue the IDs they reference with prime() and the loader resolves
+    everything still pending with a single db.get_all() round trip, no matter
+    how many collections or IDs are involved. Results (including misses) are
+    cached for the lifetime of the loader, so a document is read at most once
+    per request.
+    """
+
+    def flush(self) -> None:
+        """Fetch all pending documents in one batched read"""
+        refs = self._take_pending_refs()
+        if not refs:
+            return
+        for snapshot in self.db.get_all(refs):
+            self._store(snapshot)
+
+    def load_many(self, collection: str, ids: Iterable[Optional[str]]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """Return {id: document dict or None} for the given IDs"""
+        ids = [doc_id for doc_id in ids if doc_id]
+        self.prime(collection, ids)
+        if self._pending:
+            self.flush()
+        return self._cached(collection, ids)
+
+    def load(self, collection: str, doc_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Return a single document dict, or None if it doesn't exist"""
+        if not doc_id:
+            return None
+        return self.load_many(collection, [doc_id]).get(doc_id)
+
+
+class AsyncDocumentLoader(_BaseDocumentLoader):
+    """DocumentLoader counterpart for the async Firestore client"""
+
+    async def flush(self) -> None:
+        """Fetch all pending documents in one batched read"""
+        refs = self._take_pending_refs()
+        if not refs:
+            return
+        async for snapshot in self.db.get_all(refs):
+            self._store(snapshot)
+
+    async def load_many(self, collection: str, ids: Iterable[Optional[str]]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """Return {id: document dict or None} for the given IDs"""
+        ids = [doc_id for doc_id in ids if doc_id]
+        self.prime(collection, ids)
+        if self._pending:
+            await self.flush()
+        return self._cached(collection, ids)
+
+    async def load(self, collection: str, doc_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Return a single document dict, or None if it doesn't exist"""
+        if not doc_id:
+            return None
+        return (await self.load_many(collection, [doc_id])).get(doc_id)
+
+
+def get_loader(db = Depends(get_db)) -> DocumentLoader:
+    """Per-request DocumentLoader dependency"""
+    return DocumentLoader(db)
+
+
+def get_async_loader(db = Depends(get_async_db)) -> AsyncDocumentLoader:
+    """Per-request AsyncDocumentLoader dependency"""
+    return AsyncDocumentLoader(db)
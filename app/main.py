@@ -1,9 +1,26 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.responses import HTMLResponse, JSONResponse
 from app.routers import materials, purchases, products, cost, dashboard
 from app.jinja_templates import templates
+from app import http_client, image_variants
+from app.materials_cache import materials_cache
 
-app = FastAPI(title="Ethera Jewelry")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared pooled HTTP client for outbound calls (FX rate providers)
+    await http_client.open_client()
+    # In-memory materials kept current by a Firestore listener
+    await asyncio.to_thread(materials_cache.start)
+    yield
+    materials_cache.stop()
+    image_variants.shutdown()
+    await http_client.close_client()
+
+
+app = FastAPI(title="Ethera Jewelry", lifespan=lifespan)
 
 # Health check endpoint for Cloud Run
 @app.get("/health")
@@ -15,6 +32,7 @@ app.include_router(materials.router, prefix="/api/materials", tags=["materials"]
 app.include_router(purchases.router, prefix="/api/purchases", tags=["purchases"])
 app.include_router(products.router, prefix="/api/products", tags=["products"])
 app.include_router(cost.router, prefix="/api", tags=["cost"])
+app.include_router(dashboard.router, prefix="/api/dashboard", tags=["dashboard"])
 
 # Include HTML routers
 app.include_router(materials.html_router, tags=["materials-html"])
@@ -0,0 +1,134 @@
+import os
+import threading
+from typing import Dict, Any, Optional, Iterable
+from app import database
+from app.firestore_models import document_to_dict
+
+
+class MaterialsCache:
+    """Process-wide copy of the (small) materials collection
+
+    Kept current by a Firestore on_snapshot listener, so material dropdowns
+    and name lookups cost no reads per request. When FIRESTORE_EMULATOR_HOST
+    is set, or the listener cannot be started, the collection is polled every
+    MATERIALS_CACHE_POLL_INTERVAL seconds instead. Write paths in this process
+    also update the cache directly so their own changes show up immediately.
+
+    The collection is loaded once in start() (run off the event loop by the
+    lifespan); reads never load it synchronously. If that load failed, a read
+    only schedules a background refresh and serves what is cached meanwhile.
+    """
+
+    def __init__(self, collection: str = "materials"):
+        self.collection = collection
+        self.poll_interval = float(os.getenv("MATERIALS_CACHE_POLL_INTERVAL", "5"))
+        self._lock = threading.Lock()
+        self._materials: Dict[str, Dict[str, Any]] = {}
+        self._sorted: list = []
+        self._ready = False
+        self._watch = None
+        self._stop = threading.Event()
+        self._poller: Optional[threading.Thread] = None
+        self._warming: Optional[threading.Thread] = None
+
+    # Lifecycle
+
+    def start(self) -> None:
+        if database.db is None or self._watch is not None or self._poller is not None:
+            return
+        self._stop.clear()
+        self.refresh()
+        if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+            try:
+                self._watch = database.db.collection(self.collection).on_snapshot(self._on_snapshot)
+                print("✓ Materials cache listening for changes")
+                return
+            except Exception as e:
+                print(f"⚠ Could not start materials listener, polling instead: {e}")
+        self._poller = threading.Thread(target=self._poll, name="materials-cache-poller", daemon=True)
+        self._poller.start()
+        print(f"✓ Materials cache polling every {self.poll_interval}s")
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._watch is not None:
+            try:
+                self._watch.unsubscribe()
+            except Exception as e:
+                print(f"⚠ Could not stop materials listener: {e}")
+            self._watch = None
+        if self._poller is not None:
+            self._poller.join(timeout=self.poll_interval + 1)
+            self._poller = None
+
+    def _on_snapshot(self, docs, changes, read_time) -> None:
+        self._replace(docs)
+
+    def _poll(self) -> None:
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(self.poll_interval)
+
+    def refresh(self) -> None:
+        """Reload the whole collection (polling, and reads before the first snapshot)"""
+        try:
+            self._replace(database.db.collection(self.collection).stream())
+        except Exception as e:
+            print(f"⚠ Could not refresh materials cache: {e}")
+
+    def _replace(self, docs: Iterable) -> None:
+        materials = {}
+        for doc in docs:
+            material = document_to_dict(doc)
+            if material:
+                materials[material["id"]] = material
+        with self._lock:
+            self._set(materials)
+            self._ready = True
+
+    def _set(self, materials: Dict[str, Dict[str, Any]]) -> None:
+        self._materials = materials
+        self._sorted = sorted(materials.values(), key=lambda m: m.get("name") or "")
+
+    def _ensure_ready(self) -> None:
+        """Kick off a background load if the cache is still empty; never blocks the caller"""
+        if self._ready or database.db is None:
+            return
+        with self._lock:
+            if self._warming is not None and self._warming.is_alive():
+                return
+            self._warming = threading.Thread(target=self.refresh, name="materials-cache-warmup", daemon=True)
+            self._warming.start()
+
+    # Reads
+
+    def all(self) -> list:
+        """All materials ordered by name"""
+        self._ensure_ready()
+        with self._lock:
+            return list(self._sorted)
+
+    def get(self, material_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        self._ensure_ready()
+        with self._lock:
+            return self._materials.get(material_id)
+
+    def get_many(self, material_ids: Iterable[Optional[str]]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """{material_id: material or None}, same shape as DocumentLoader.load_many()"""
+        self._ensure_ready()
+        with self._lock:
+            return {mid: self._materials.get(mid) for mid in material_ids if mid}
+
+    # Local writes
+
+    def upsert(self, material: Dict[str, Any]) -> None:
+        with self._lock:
+            self._set({**self._materials, material["id"]: material})
+
+    def discard(self, material_ids: Iterable[str]) -> None:
+        with self._lock:
+            material_ids = set(material_ids)
+            self._set({mid: m for mid, m in self._materials.items() if mid not in material_ids})
+
+
+materials_cache = MaterialsCache()
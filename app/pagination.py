@@ -0,0 +1,81 @@
+import base64
+import json
+from datetime import datetime
+from typing import Dict, Any, Optional
+from fastapi import HTTPException
+from firebase_admin import firestore
+from app.firestore_models import document_to_dict
+
+
+def encode_cursor(item: Dict[str, Any], field: str, direction: str = "next") -> str:
+    """Build an opaque cursor token from the ordering field and id of a document"""
+    value = item.get(field)
+    if isinstance(value, datetime):
+        payload = {"v": value.isoformat(), "t": "dt"}
+    else:
+        payload = {"v": value, "t": "raw"}
+    payload.update({"f": field, "id": item["id"], "d": direction})
+    raw = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token: str, field: str) -> Dict[str, Any]:
+    """Decode a cursor token, rejecting tokens built for a different ordering"""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        if payload.get("f") != field or payload.get("d") not in ("next", "prev") or not payload.get("id"):
+            raise ValueError("cursor does not match this listing")
+        if payload.get("t") == "dt":
+            payload["v"] = datetime.fromisoformat(payload["v"])
+        return payload
+    except HTTPException:
+        raise
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_query(collection_ref, field: str, per_page: int, cursor: Optional[str] = None, descending: bool = False):
+    """Build a query for one page of a keyset-paginated listing
+
+    Results are ordered by `field` with the document id as tie-breaker, and the
+    cursor resumes with start_after / end_before so deep pages cost the same as
+    the first one. One extra document is requested to detect whether another
+    page exists. Prev-direction queries use limit_to_last, so callers must run
+    them with get() rather than stream().
+    """
+    direction = firestore.Query.DESCENDING if descending else firestore.Query.ASCENDING
+    query = collection_ref.order_by(field, direction=direction).order_by("__name__", direction=direction)
+    if not cursor:
+        return query.limit(per_page + 1)
+
+    payload = decode_cursor(cursor, field)
+    values = [payload["v"], collection_ref.document(payload["id"])]
+    if payload["d"] == "prev":
+        return query.end_before(values).limit_to_last(per_page + 1)
+    return query.start_after(values).limit(per_page + 1)
+
+
+def keyset_page(snapshots, field: str, per_page: int, cursor: Optional[str] = None) -> Dict[str, Any]:
+    """Turn the snapshots returned by a keyset_query into a page with prev/next cursors"""
+    items = []
+    for snapshot in snapshots:
+        item = document_to_dict(snapshot)
+        if item:
+            items.append(item)
+
+    backwards = bool(cursor) and decode_cursor(cursor, field)["d"] == "prev"
+    if backwards:
+        has_prev = len(items) > per_page
+        items = items[-per_page:]
+        has_next = True
+    else:
+        has_next = len(items) > per_page
+        items = items[:per_page]
+        has_prev = bool(cursor)
+
+    return {
+        "items": items,
+        "next_cursor": encode_cursor(items[-1], field, "next") if has_next and items else None,
+        "prev_cursor": encode_cursor(items[0], field, "prev") if has_prev and items else None,
+    }
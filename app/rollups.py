@@ -0,0 +1,217 @@
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, Optional, Iterable
+from firebase_admin import firestore
+
+# One document per day: daily_rollups/{YYYY-MM-DD}
+ROLLUPS_COLLECTION = "daily_rollups"
+# Records whether the rollups have been backfilled from existing data
+ROLLUPS_STATE_DOC = ("rollup_state", "daily_rollups")
+# How long a rebuild may hold the state document before another request takes over
+ROLLUPS_BUILD_LEASE = timedelta(minutes=15)
+
+# Numeric fields and map fields (maps of key -> number) kept in each rollup document
+#   products_created / products_count_total / product_count_by_name - by product created_at
+#   materials_created / materials_by_type                           - by material created_at
+#   purchases / spend / spend_by_currency / inventory_by_currency /
+#   qty_by_material                                                  - by purchase_date
+
+
+def _day(value) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.date().strftime('%Y-%m-%d')
+    try:
+        return datetime.fromisoformat(str(value)).date().strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+
+
+def _key(value, default: str = "Unknown") -> str:
+    value = str(value) if value is not None else ""
+    return value if value.strip() else default
+
+
+def _contribution(kind: str, data: Optional[Dict[str, Any]]) -> Optional[tuple]:
+    """(day, delta) a single document adds to the rollups, or None"""
+    if not data:
+        return None
+    if kind == "products":
+        day = _day(data.get("created_at"))
+        count = data.get("count")
+        count = 1 if count is None else count
+        return day, {
+            "products_created": 1,
+            "products_count_total": count,
+            "product_count_by_name": {_key(data.get("name")): count},
+        }
+    if kind == "materials":
+        day = _day(data.get("created_at"))
+        return day, {
+            "materials_created": 1,
+            "materials_by_type": {_key(data.get("type"), "OTHER"): 1},
+        }
+    if kind == "purchases":
+        day = _day(data.get("purchase_date"))
+        currency = _key(data.get("currency"), "USD")
+        # Fields may be stored as None (e.g. qty_remaining from the HTML edit form)
+        unit_cost = data.get("unit_cost") or 0
+        spending = float((data.get("qty_purchased") or 0) * unit_cost)
+        delta = {
+            "purchases": 1,
+            "spend": spending,
+            "spend_by_currency": {currency: spending},
+            "inventory_by_currency": {currency: float((data.get("qty_remaining") or 0) * unit_cost)},
+        }
+        if data.get("material_id"):
+            delta["qty_by_material"] = {data["material_id"]: float(data.get("qty_purchased") or 0)}
+        return day, delta
+    raise ValueError(f"Unknown rollup kind: {kind}")
+
+
+def _accumulate(target: Dict[str, Any], delta: Dict[str, Any], sign: int) -> None:
+    for field, value in delta.items():
+        if isinstance(value, dict):
+            bucket = target.setdefault(field, defaultdict(float))
+            for key, amount in value.items():
+                bucket[key] += sign * amount
+        else:
+            target[field] = target.get(field, 0) + sign * value
+
+
+def _as_increments(delta: Dict[str, Any]) -> Dict[str, Any]:
+    """Turn a delta into a set(merge=True) payload of Increment transforms, dropping zeros"""
+    payload = {}
+    for field, value in delta.items():
+        if isinstance(value, dict):
+            increments = {key: firestore.Increment(amount) for key, amount in value.items() if amount}
+            if increments:
+                payload[field] = increments
+        elif value:
+            payload[field] = firestore.Increment(value)
+    return payload
+
+
+def record_changes(db, changes: Iterable[tuple]) -> None:
+    """Apply document changes to the daily rollups in one batch
+
+    Each change is (kind, old, new) with kind in products/materials/purchases
+    and old/new the document dicts before and after (None for create/delete).
+    Never raises: the rollups must not fail the write that triggered them.
+    """
+    try:
+        deltas: Dict[str, Dict[str, Any]] = defaultdict(dict)
+        for kind, old, new in changes:
+            for data, sign in ((old, -1), (new, 1)):
+                contribution = _contribution(kind, data)
+                if contribution and contribution[0]:
+                    _accumulate(deltas[contribution[0]], contribution[1], sign)
+
+        batch = db.batch()
+        writes = 0
+        for day, delta in deltas.items():
+            payload = _as_increments(delta)
+            if payload:
+                payload["date"] = day
+                batch.set(db.collection(ROLLUPS_COLLECTION).document(day), payload, merge=True)
+                writes += 1
+        if writes:
+            batch.commit()
+    except Exception as e:
+        print(f"⚠ Could not update daily rollups: {e}")
+
+
+def record_change(db, kind: str, old: Optional[Dict[str, Any]], new: Optional[Dict[str, Any]]) -> None:
+    """record_changes() for a single document"""
+    record_changes(db, [(kind, old, new)])
+
+
+@firestore.async_transactional
+async def _acquire_build_lease(transaction, state_ref) -> bool:
+    """Claim the one-time rebuild; False if it is done or another builder holds an unexpired lease"""
+    snapshot = await state_ref.get(transaction=transaction)
+    state = (snapshot.to_dict() or {}) if snapshot.exists else {}
+    if state.get("initialized"):
+        return False
+    now = datetime.now(timezone.utc)
+    building_until = state.get("building_until")
+    if building_until and building_until > now:
+        return False
+    transaction.set(state_ref, {"initialized": False, "building_until": now + ROLLUPS_BUILD_LEASE})
+    return True
+
+
+async def _commit_in_batches(db, writes: list) -> None:
+    """Apply (op, ref, data) writes in batches of at most 400"""
+    for i in range(0, len(writes), 400):
+        batch = db.batch()
+        for op, ref, data in writes[i:i + 400]:
+            if op == "delete":
+                batch.delete(ref)
+            else:
+                batch.set(ref, data, merge=True)
+        await batch.commit()
+
+
+async def ensure_rollups(db) -> None:
+    """Backfill the rollups from the full history once (async client)
+
+    Runs the first time the dashboard is opened against a database that
+    predates the rollups; afterwards the write paths keep them current.
+    A lease on the rollup_state document lets only one request or instance
+    rebuild at a time (an abandoned build is retried once the lease
+    expires), and "initialized" is only set after every batch committed.
+
+    The old rollup documents are deleted before the collections are read and
+    the totals are merged in as Increments, so increments written by
+    record_changes() during the rebuild are never overwritten. Purchases
+    without a parseable purchase_date have no day and are not counted in the
+    rollups (purchase count and spend), unlike the pre-rollup dashboard.
+    """
+    state_ref = db.collection(ROLLUPS_STATE_DOC[0]).document(ROLLUPS_STATE_DOC[1])
+    state = await state_ref.get()
+    if state.exists and (state.to_dict() or {}).get("initialized"):
+        return
+    if not await _acquire_build_lease(db.transaction(), state_ref):
+        return  # Already built, or another builder is at it; serve the rollups as they are
+
+    print("Building daily rollups from existing data...")
+    rollups_ref = db.collection(ROLLUPS_COLLECTION)
+    await _commit_in_batches(db, [("delete", doc.reference, None) async for doc in rollups_ref.stream()])
+
+    totals: Dict[str, Dict[str, Any]] = defaultdict(dict)
+    for kind in ("products", "materials", "purchases"):
+        async for doc in db.collection(kind).stream():
+            contribution = _contribution(kind, doc.to_dict())
+            if contribution and contribution[0]:
+                _accumulate(totals[contribution[0]], contribution[1], 1)
+
+    writes = []
+    for day, delta in totals.items():
+        payload = _as_increments(delta)
+        if payload:
+            payload["date"] = day
+            writes.append(("set", rollups_ref.document(day), payload))
+    await _commit_in_batches(db, writes)
+    await state_ref.set({
+        "initialized": True,
+        "built_at": firestore.SERVER_TIMESTAMP,
+        "building_until": firestore.DELETE_FIELD
+    }, merge=True)
+    print(f"✓ Built {len(totals)} daily rollup document(s)")
+
+
+async def load_rollups(db, start: Optional[str] = None, end: Optional[str] = None) -> list:
+    """Rollup documents ordered by day, optionally bounded to start..end ('YYYY-MM-DD', inclusive)"""
+    query = db.collection(ROLLUPS_COLLECTION)
+    if start:
+        query = query.where("date", ">=", start)
+    if end:
+        query = query.where("date", "<=", end)
+    rollups = []
+    async for doc in query.order_by("date").stream():
+        data = doc.to_dict()
+        if data:
+            rollups.append(data)
+    return rollups
@@ -1,12 +1,15 @@
-from fastapi import APIRouter, Depends, Request
-from fastapi.responses import HTMLResponse
-from firebase_admin import firestore
-from datetime import datetime
-from app.database import get_db
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import HTMLResponse, Response
+from app.database import get_async_db
 from app.jinja_templates import templates
-from app.firestore_models import document_to_dict
+from app.rollups import ensure_rollups, load_rollups
+from app.cache import dashboard_cache
+from collections import Counter
+from datetime import date, timedelta
+from typing import Literal, Optional
+import os
+import hashlib
 import json
-from collections import defaultdict
 
 
 def get_fallback_exchange_rate(base_currency: str, target_currency: str) -> float:
@@ -31,235 +34,233 @@ def get_fallback_exchange_rate(base_currency: str, target_currency: str) -> floa
     }
     return default_rates.get(base_currency, {}).get(target_currency, 1.0)
 
+
+async def load_material_names(db, material_ids: list) -> dict:
+    """ID -> name map for the given materials from a single batched read (deleted ones are omitted)"""
+    if not material_ids:
+        return {}
+    refs = [db.collection("materials").document(material_id) for material_id in material_ids]
+    names = {}
+    async for doc in db.get_all(refs, field_paths=["name"]):
+        if doc.exists:
+            names[doc.id] = (doc.to_dict() or {}).get("name", "Unknown")
+    return names
+
+
+router = APIRouter()
 html_router = APIRouter()
 
+# Payloads served by /api/dashboard/{chart}
+CHARTS = (
+    "stats",
+    "products_over_time",
+    "materials_by_type",
+    "purchases_over_time",
+    "spending_over_time",
+    "inventory_value",
+    "top_materials",
+    "products_by_count",
+)
+
+
+Bucket = Literal["day", "week", "month"]
+
+# Longest time series sent to the charts unless ?max_points= says otherwise (0 = no downsampling)
+DEFAULT_MAX_POINTS = int(os.getenv("DASHBOARD_MAX_POINTS", "180"))
+
+
+def bucket_key(day: str, bucket: str) -> str:
+    """Time-series label a 'YYYY-MM-DD' day falls into: the day, its week's Monday, or 'YYYY-MM'"""
+    if bucket == "month":
+        return day[:7]
+    if bucket == "week":
+        parsed = date.fromisoformat(day)
+        return (parsed - timedelta(days=parsed.weekday())).isoformat()
+    return day
+
+
+def downsample(points: dict, max_points: Optional[int]) -> dict:
+    """Sum consecutive points into at most max_points buckets, each labelled by its first label
+
+    The time series are additive (counts and spend), so a merged bucket keeps
+    the same total as the points it replaces.
+    """
+    labels, data = points["labels"], points["data"]
+    if not max_points or len(labels) <= max_points:
+        return points
+    size = -(-len(labels) // max_points)  # ceil
+    return {
+        "labels": labels[::size],
+        "data": [sum(data[i:i + size]) for i in range(0, len(data), size)]
+    }
+
+
+@router.get("/{chart}")
+async def get_dashboard_chart(
+    chart: str,
+    request: Request,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    bucket: Bucket = "day",
+    max_points: Optional[int] = Query(DEFAULT_MAX_POINTS, ge=0),
+    db = Depends(get_async_db)
+):
+    """
+    One dashboard chart (or "stats") as JSON.
+    start/end (inclusive) limit every chart and stat to that date range;
+    bucket groups the time series by day, week or month, and series longer
+    than max_points are downsampled by merging consecutive buckets
+    (max_points=0 turns downsampling off).
+    Sends an ETag of the payload; a matching If-None-Match gets a 304.
+    """
+    if chart not in CHARTS:
+        raise HTTPException(status_code=404, detail="Chart not found")
+    if start and end and start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+    start_str = start.isoformat() if start else None
+    end_str = end.isoformat() if end else None
+    data = await dashboard_cache.get_or_compute(
+        f"dashboard:{start_str}:{end_str}:{bucket}:{max_points}",
+        lambda: build_dashboard_data(db, start_str, end_str, bucket, max_points)
+    )
+    body = json.dumps(data[chart], sort_keys=True, separators=(",", ":"))
+    etag = '"' + hashlib.sha256(body.encode()).hexdigest()[:32] + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 
 @html_router.get("/dashboard", response_class=HTMLResponse)
-async def dashboard_page(request: Request, db = Depends(get_db)):
-    # Products over time
-    products_ref = db.collection("products")
-    product_docs = products_ref.order_by("created_at").stream()
-    products = []
-    for doc in product_docs:
-        product = document_to_dict(doc)
-        if product:
-            products.append(product)
-    
-    if products:
-        product_dates = []
-        for p in products:
-            created_at = p.get("created_at")
-            if created_at:
-                if isinstance(created_at, datetime):
-                    product_dates.append(created_at.date())
-                else:
-                    # Try to parse if it's a string
-                    try:
-                        product_dates.append(datetime.fromisoformat(str(created_at)).date())
-                    except:
-                        pass
-        
-        product_counts = {}
-        for date in product_dates:
-            product_counts[date] = product_counts.get(date, 0) + 1
-        
-        sorted_dates = sorted(product_counts.keys())
-        products_over_time = {
-            "labels": [d.strftime("%Y-%m-%d") for d in sorted_dates],
-            "data": [product_counts[d] for d in sorted_dates]
+async def dashboard_page(request: Request, start: Optional[date] = None, end: Optional[date] = None, bucket: Bucket = "day"):
+    # Only the page shell - the stats and each chart are fetched from /api/dashboard/{chart}
+    query = {"bucket": bucket}
+    if start:
+        query["start"] = start.isoformat()
+    if end:
+        query["end"] = end.isoformat()
+    return templates.TemplateResponse(
+        "dashboard.html",
+        {
+            "request": request,
+            "charts": CHARTS,
+            "query": query,
+            "start": query.get("start"),
+            "end": query.get("end"),
+            "bucket": bucket
         }
-    else:
-        products_over_time = {"labels": [], "data": []}
+    )
+
+
+async def build_dashboard_data(
+    db,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    bucket: str = "day",
+    max_points: Optional[int] = None
+) -> dict:
+    """Every dashboard payload keyed by chart name (cached in dashboard_cache)"""
+    # All charts come from the pre-aggregated daily rollups, read only for the requested range
+    await ensure_rollups(db)
+    rollups = await load_rollups(db, start, end)
     
-    # Materials by type
-    materials_ref = db.collection("materials")
-    material_docs = materials_ref.stream()
-    materials = []
-    for doc in material_docs:
-        material = document_to_dict(doc)
-        if material:
-            materials.append(material)
+    def sum_maps(field):
+        totals = Counter()
+        for rollup in rollups:
+            totals.update(rollup.get(field) or {})
+        return totals
     
-    if materials:
-        material_types = {}
-        for material in materials:
-            mat_type = material.get("type", "OTHER")
-            material_types[mat_type] = material_types.get(mat_type, 0) + 1
-        
-        materials_by_type = {
-            "labels": list(material_types.keys()),
-            "data": list(material_types.values())
-        }
-    else:
-        materials_by_type = {"labels": [], "data": []}
+    def series(field, present_field=None):
+        # Sum per bucket, keeping only buckets where present_field (default: field) is non-zero
+        present_field = present_field or field
+        totals = {}
+        for r in rollups:
+            if r.get(present_field):
+                key = bucket_key(r["date"], bucket)
+                totals[key] = totals.get(key, 0) + r.get(field, 0)
+        return downsample({
+            "labels": list(totals.keys()),
+            "data": list(totals.values())
+        }, max_points)
     
-    # Purchases over time
-    purchases_ref = db.collection("purchases")
-    purchase_docs = purchases_ref.order_by("purchase_date").stream()
-    purchases = []
-    for doc in purchase_docs:
-        purchase = document_to_dict(doc)
-        if purchase:
-            purchases.append(purchase)
+    # Products over time
+    products_over_time = series("products_created")
     
-    if purchases:
-        purchase_dates = []
-        for p in purchases:
-            purchase_date = p.get("purchase_date")
-            if purchase_date:
-                if isinstance(purchase_date, datetime):
-                    purchase_dates.append(purchase_date.date())
-                else:
-                    try:
-                        purchase_dates.append(datetime.fromisoformat(str(purchase_date)).date())
-                    except:
-                        pass
-        
-        purchase_counts = {}
-        for date in purchase_dates:
-            purchase_counts[date] = purchase_counts.get(date, 0) + 1
-        
-        sorted_purchase_dates = sorted(purchase_counts.keys())
-        purchases_over_time = {
-            "labels": [d.strftime("%Y-%m-%d") for d in sorted_purchase_dates],
-            "data": [purchase_counts[d] for d in sorted_purchase_dates]
-        }
-    else:
-        purchases_over_time = {"labels": [], "data": []}
+    # Materials by type
+    material_types = {k: v for k, v in sum_maps("materials_by_type").items() if v > 0}
+    materials_by_type = {
+        "labels": list(material_types.keys()),
+        "data": list(material_types.values())
+    }
     
-    # Spending over time
-    if purchases:
-        spending_by_date = {}
-        for purchase in purchases:
-            purchase_date = purchase.get("purchase_date")
-            if purchase_date:
-                if isinstance(purchase_date, datetime):
-                    date = purchase_date.date()
-                else:
-                    try:
-                        date = datetime.fromisoformat(str(purchase_date)).date()
-                    except:
-                        continue
-                
-                spending = float(purchase.get("qty_purchased", 0) * purchase.get("unit_cost", 0))
-                if date not in spending_by_date:
-                    spending_by_date[date] = 0.0
-                spending_by_date[date] += spending
-        
-        sorted_spending_dates = sorted(spending_by_date.keys())
-        spending_over_time = {
-            "labels": [d.strftime("%Y-%m-%d") for d in sorted_spending_dates],
-            "data": [spending_by_date[d] for d in sorted_spending_dates]
-        }
-    else:
-        spending_over_time = {"labels": [], "data": []}
+    # Purchases over time
+    purchases_over_time = series("purchases")
+    
+    # Spending over time (on days with purchases)
+    spending_over_time = series("spend", "purchases")
+    spending_over_time["data"] = [float(value) for value in spending_over_time["data"]]
     
     # Total inventory value by currency
-    if purchases:
-        inventory_by_currency = defaultdict(float)
-        for purchase in purchases:
-            currency = purchase.get("currency", "USD")
-            qty_remaining = purchase.get("qty_remaining", 0)
-            unit_cost = purchase.get("unit_cost", 0)
-            inventory_by_currency[currency] += float(qty_remaining * unit_cost)
-        
-        currencies = list(inventory_by_currency.keys())
-        values = [inventory_by_currency[c] for c in currencies]
-        inventory_value = {"labels": currencies, "data": values}
-    else:
-        inventory_value = {"labels": [], "data": []}
+    inventory_by_currency = {k: float(v) for k, v in sum_maps("inventory_by_currency").items() if v}
+    inventory_value = {
+        "labels": list(inventory_by_currency.keys()),
+        "data": list(inventory_by_currency.values())
+    }
     
-    # Top materials by purchase quantity
-    if purchases:
-        material_qty_map = defaultdict(float)
-        material_name_map = {}
-        
-        for purchase in purchases:
-            material_id = purchase.get("material_id")
-            if material_id:
-                material_doc = db.collection("materials").document(material_id).get()
-                if material_doc.exists:
-                    material = document_to_dict(material_doc)
-                    if material:
-                        material_name = material.get("name", "Unknown")
-                        material_name_map[material_id] = material_name
-                        qty = purchase.get("qty_purchased", 0)
-                        material_qty_map[material_id] += float(qty)
-        
-        # Sort by quantity and take top 10
-        sorted_materials = sorted(material_qty_map.items(), key=lambda x: x[1], reverse=True)[:10]
-        material_names = [material_name_map.get(mid, "Unknown") for mid, _ in sorted_materials]
-        material_qtys = [qty for _, qty in sorted_materials]
-        top_materials_data = {"labels": material_names, "data": material_qtys}
-    else:
-        top_materials_data = {"labels": [], "data": []}
+    # Top 10 materials by purchase quantity that still exist; rollups keep quantities of
+    # deleted materials, so names are resolved in batched reads down the ranking until 10 are found
+    ranked = Counter({k: v for k, v in sum_maps("qty_by_material").items() if v > 0}).most_common()
+    top_materials = []
+    for i in range(0, len(ranked), 20):
+        if len(top_materials) >= 10:
+            break
+        chunk = ranked[i:i + 20]
+        material_names = await load_material_names(db, [material_id for material_id, _ in chunk])
+        top_materials += [
+            (material_names[material_id], qty) for material_id, qty in chunk if material_id in material_names
+        ]
+    top_materials = top_materials[:10]
+    top_materials_data = {
+        "labels": [name for name, _ in top_materials],
+        "data": [float(qty) for _, qty in top_materials]
+    }
     
     # Products by total count
-    if products:
-        product_count_map = {}
-        for product in products:
-            product_name = product.get("name", "Unknown")
-            count = product.get("count", 1)
-            product_count_map[product_name] = product_count_map.get(product_name, 0) + count
-        
-        # Sort by count and take top 10
-        sorted_products = sorted(product_count_map.items(), key=lambda x: x[1], reverse=True)[:10]
-        product_names = [name for name, _ in sorted_products]
-        product_counts_list = [count for _, count in sorted_products]
-        products_by_count = {"labels": product_names, "data": product_counts_list}
-    else:
-        products_by_count = {"labels": [], "data": []}
+    product_count_map = {k: v for k, v in sum_maps("product_count_by_name").items() if v > 0}
+    sorted_products = sorted(product_count_map.items(), key=lambda x: x[1], reverse=True)[:10]
+    products_by_count = {
+        "labels": [name for name, _ in sorted_products],
+        "data": [count for _, count in sorted_products]
+    }
     
     # Statistics
-    total_products = len(products)
-    total_materials = len(materials)
-    total_purchases = len(purchases)
-    total_products_count = sum(p.get("count", 1) for p in products)
+    total_products = int(sum(r.get("products_created", 0) for r in rollups))
+    total_materials = int(sum(r.get("materials_created", 0) for r in rollups))
+    total_purchases = int(sum(r.get("purchases", 0) for r in rollups))
+    total_products_count = sum(r.get("products_count_total", 0) for r in rollups)
     
-    # Calculate spending by currency (sum of all purchases across all materials: qty_purchased * unit_cost)
-    spending_by_currency_dict = {}
-    if purchases:
-        for purchase in purchases:
-            currency = purchase.get("currency", "USD")
-            spending = float(purchase.get("qty_purchased", 0) * purchase.get("unit_cost", 0))
-            spending_by_currency_dict[currency] = spending_by_currency_dict.get(currency, 0.0) + spending
+    # Spending by currency (sum of all purchases across all materials: qty_purchased * unit_cost)
+    spending_by_currency_dict = {k: float(v) for k, v in sum_maps("spend_by_currency").items() if v}
     
-    # Calculate total spending in TRY by converting each purchase using fallback exchange rates
+    # Calculate total spending in TRY by converting each currency total using fallback exchange rates
     total_spending_try = 0.0
     exchange_rate_info = []  # Track which rates were used
     
-    for purchase in purchases:
-        purchase_amount = float(purchase.get("qty_purchased", 0) * purchase.get("unit_cost", 0))
-        purchase_currency = purchase.get("currency", "USD")
-        
-        if purchase_currency == "TRY":
-            total_spending_try += purchase_amount
+    for currency, amount in spending_by_currency_dict.items():
+        if currency == "TRY":
+            total_spending_try += amount
         else:
             # Get fallback exchange rate (no API calls)
-            rate = get_fallback_exchange_rate(purchase_currency, "TRY")
-            converted_amount = purchase_amount * rate
-            total_spending_try += converted_amount
-            
-            # Track exchange rate info (only add unique currency combinations)
-            rate_key = purchase_currency
-            if not any(r.get('key') == rate_key for r in exchange_rate_info):
-                exchange_rate_info.append({
-                    'key': rate_key,
-                    'currency': purchase_currency,
-                    'rate': rate
-                })
+            rate = get_fallback_exchange_rate(currency, "TRY")
+            total_spending_try += amount * rate
+            exchange_rate_info.append({
+                'key': currency,
+                'currency': currency,
+                'rate': rate
+            })
     
-    return templates.TemplateResponse(
-        "dashboard.html",
-        {
-            "request": request,
-            "products_over_time": json.dumps(products_over_time),
-            "materials_by_type": json.dumps(materials_by_type),
-            "purchases_over_time": json.dumps(purchases_over_time),
-            "spending_over_time": json.dumps(spending_over_time),
-            "inventory_value": json.dumps(inventory_value),
-            "top_materials": json.dumps(top_materials_data),
-            "products_by_count": json.dumps(products_by_count),
+    return {
+        "stats": {
             "total_products": total_products,
             "total_materials": total_materials,
             "total_purchases": total_purchases,
@@ -267,5 +268,12 @@ async def dashboard_page(request: Request, db = Depends(get_db)):
             "spending_by_currency": spending_by_currency_dict,
             "total_spending_try": total_spending_try,
             "exchange_rate_info": exchange_rate_info
-        }
-    )
+        },
+        "products_over_time": products_over_time,
+        "materials_by_type": materials_by_type,
+        "purchases_over_time": purchases_over_time,
+        "spending_over_time": spending_over_time,
+        "inventory_value": inventory_value,
+        "top_materials": top_materials_data,
+        "products_by_count": products_by_count
+    }
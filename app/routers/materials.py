@@ -1,26 +1,60 @@
-from fastapi import APIRouter, Depends, HTTPException, Request, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Form
+from typing import Optional
+from fastapi.responses import HTMLResponse, RedirectResponse, Response
 from firebase_admin import firestore
+from google.api_core.exceptions import FailedPrecondition
 from app.database import get_db
+from app.pagination import keyset_query, keyset_page
+from app.counters import increment_count, get_count
+from app.cost_snapshots import mark_products_stale, products_referencing
+from app.cache import invalidate_dashboard_on_write
+from app.rollups import record_change, record_changes
+from app.materials_cache import materials_cache
+from app.suppliers import record_supplier_changes
 from app import schemas, models
 from app.jinja_templates import templates
 from app.firestore_models import document_to_dict, datetime_to_timestamp
 from datetime import datetime
 
-router = APIRouter()
-html_router = APIRouter()
+# Writes through these routers invalidate the cached dashboard
+router = APIRouter(dependencies=[Depends(invalidate_dashboard_on_write)])
+html_router = APIRouter(dependencies=[Depends(invalidate_dashboard_on_write)])
 
 
 @router.get("/", response_model=list[schemas.Material])
-def get_materials(skip: int = 0, limit: int = 100, db = Depends(get_db)):
+def get_materials(response: Response, skip: int = 0, limit: int = 100, cursor: Optional[str] = None, db = Depends(get_db)):
     materials_ref = db.collection("materials")
-    docs = materials_ref.order_by("name").offset(skip).limit(limit).stream()
-    materials = []
-    for doc in docs:
-        material = document_to_dict(doc)
-        if material:
-            materials.append(material)
-    return materials
+    if skip:
+        # Legacy offset paging - Firestore still reads every skipped document
+        docs = materials_ref.order_by("name").offset(skip).limit(limit).stream()
+        materials = []
+        for doc in docs:
+            material = document_to_dict(doc)
+            if material:
+                materials.append(material)
+        return materials
+    
+    # Keyset pagination: pass X-Next-Cursor / X-Prev-Cursor back as ?cursor= to move between pages
+    query = keyset_query(materials_ref, "name", limit, cursor)
+    result = keyset_page(query.get(), "name", limit, cursor)
+    if result["next_cursor"]:
+        response.headers["X-Next-Cursor"] = result["next_cursor"]
+    if result["prev_cursor"]:
+        response.headers["X-Prev-Cursor"] = result["prev_cursor"]
+    return result["items"]
+
+
+# Defined before /{material_id} so "search" isn't taken as a material ID
+@router.get("/search", response_model=list[schemas.Material])
+def search_materials(q: str = "", limit: int = Query(20, ge=1, le=100)):
+    """Material typeahead served from the in-memory materials cache (no reads)
+
+    Case-insensitive match on name; names starting with q come first.
+    """
+    needle = q.strip().casefold()
+    matches = [m for m in materials_cache.all() if needle in (m.get("name") or "").casefold()]
+    matches.sort(key=lambda m: not (m.get("name") or "").casefold().startswith(needle))
+    return matches[:limit]
 
 
 @router.get("/{material_id}", response_model=schemas.Material)
@@ -46,8 +80,12 @@ def create_material(material: schemas.MaterialCreate, db = Depends(get_db)):
             data["type"] = str(data["type"])
     data["created_at"] = firestore.SERVER_TIMESTAMP
     doc_ref.set(data)
+    increment_count(db, "materials", 1)
     doc = doc_ref.get()
-    return document_to_dict(doc)
+    created = document_to_dict(doc)
+    record_change(db, "materials", None, created)
+    materials_cache.upsert(created)
+    return created
 
 
 @router.put("/{material_id}", response_model=schemas.Material)
@@ -68,23 +106,57 @@ def update_material(material_id: str, material: schemas.MaterialUpdate, db = Dep
             update_data["type"] = str(update_data["type"])
     if update_data:
         doc_ref.update(update_data)
+        # The cost estimate breakdown carries material names
+        if "name" in update_data and update_data["name"] != (doc.to_dict() or {}).get("name"):
+            mark_products_stale(db, products_referencing(db, "material_id", material_id))
     
     updated_doc = doc_ref.get()
-    return document_to_dict(updated_doc)
+    updated = document_to_dict(updated_doc)
+    if update_data:
+        record_change(db, "materials", document_to_dict(doc), updated)
+        materials_cache.upsert(updated)
+    return updated
 
 
 @router.get("/{material_id}/purchases", response_model=list[schemas.Purchase])
-def get_material_purchases(material_id: str, db = Depends(get_db)):
+def get_material_purchases(
+    material_id: str,
+    available: bool = False,
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    db = Depends(get_db)
+):
+    """Purchases of a material, newest first; available=true keeps only those with stock left
+
+    A purchase saved without qty_remaining (the HTML edit form leaves it
+    empty) has used none of its stock, so qty_purchased stands in for it.
+    Without available, limit is pushed into the query (needs the composite
+    index material_id + purchase_date desc; falls back to sorting in Python
+    if it is missing). The available filter can't be expressed as a query on
+    documents whose qty_remaining may be None, so that case still reads
+    every purchase of the material before limiting.
+    """
     purchases_ref = db.collection("purchases")
-    # Fetch without order_by to avoid index requirement, then sort in Python
-    docs = purchases_ref.where("material_id", "==", material_id).stream()
+    query = purchases_ref.where("material_id", "==", material_id)
+    if limit and not available:
+        try:
+            docs = query.order_by("purchase_date", direction=firestore.Query.DESCENDING).limit(limit).get()
+            return [p for p in (document_to_dict(doc) for doc in docs) if p]
+        except FailedPrecondition as e:
+            print(f"⚠ Missing purchases index (material_id, purchase_date desc), sorting in Python: {e}")
+    
     purchases = []
-    for doc in docs:
+    for doc in query.stream():
         purchase = document_to_dict(doc)
-        if purchase:
-            purchases.append(purchase)
+        if not purchase:
+            continue
+        if available:
+            remaining = purchase.get("qty_remaining")
+            if remaining is None:
+                remaining = purchase.get("qty_purchased")
+            if (remaining or 0) <= 0:
+                continue
+        purchases.append(purchase)
     # Sort by purchase_date descending in Python
-    from datetime import datetime
     def sort_key(x):
         purchase_date = x.get("purchase_date")
         if purchase_date:
@@ -94,7 +166,7 @@ def get_material_purchases(material_id: str, db = Depends(get_db)):
                 return purchase_date.timestamp()
         return 0
     purchases.sort(key=sort_key, reverse=True)
-    return purchases
+    return purchases[:limit] if limit else purchases
 
 
 @router.delete("/{material_id}")
@@ -106,64 +178,49 @@ def delete_material(material_id: str, db = Depends(get_db)):
     
     # Delete all BOM lines that reference this material
     bom_lines = db.collection("product_bom").where("material_id", "==", material_id).stream()
+    affected_products = set()
     for bom_line in bom_lines:
+        affected_products.add(bom_line.to_dict().get("product_id"))
         bom_line.reference.delete()
+    mark_products_stale(db, affected_products)
     
     # Delete all purchases that reference this material
     purchases = db.collection("purchases").where("material_id", "==", material_id).stream()
+    rollup_changes = []
     for purchase in purchases:
+        rollup_changes.append(("purchases", purchase.to_dict(), None))
         purchase.reference.delete()
+    increment_count(db, "purchases", -len(rollup_changes))
     
     # Now delete the material
     doc_ref.delete()
+    increment_count(db, "materials", -1)
+    record_supplier_changes(db, (((purchase or {}).get("supplier_name"), None) for _, purchase, _ in rollup_changes))
+    rollup_changes.append(("materials", doc.to_dict(), None))
+    record_changes(db, rollup_changes)
+    materials_cache.discard([material_id])
     return {"message": "Material deleted"}
 
 
 # HTML routes
 @html_router.get("/materials", response_class=HTMLResponse)
-async def materials_page(request: Request, page: int = 1, per_page: int = 10, db = Depends(get_db)):
-    # Calculate skip
-    skip = (page - 1) * per_page
-    
-    # Get total count
+async def materials_page(request: Request, cursor: Optional[str] = None, page: int = 1, per_page: int = 10, db = Depends(get_db)):
+    # Get total count from the maintained counter
     materials_ref = db.collection("materials")
-    total_docs = materials_ref.stream()
-    total_count = sum(1 for _ in total_docs)
+    total_count = get_count(db, "materials")
     
-    # Get paginated materials
-    docs = materials_ref.order_by("name").offset(skip).limit(per_page).stream()
-    materials = []
-    for doc in docs:
-        material = document_to_dict(doc)
-        if material:
-            # Ensure type field exists (default to empty string if missing)
-            if "type" not in material:
-                material["type"] = ""
-            materials.append(material)
+    # Get one page of materials, resuming after the cursor (keyset pagination)
+    query = keyset_query(materials_ref, "name", per_page, cursor)
+    result = keyset_page(query.get(), "name", per_page, cursor)
+    materials = result["items"]
+    for material in materials:
+        # Ensure type field exists (default to empty string if missing)
+        if "type" not in material:
+            material["type"] = ""
     
     # Calculate pagination info
     total_pages = (total_count + per_page - 1) // per_page if total_count > 0 else 1
     
-    # Generate page numbers for pagination (show current page ± 2, plus first and last)
-    page_numbers = []
-    if total_pages <= 7:
-        # Show all pages if 7 or fewer
-        page_numbers = list(range(1, total_pages + 1))
-    else:
-        # Show first page
-        page_numbers.append(1)
-        # Show pages around current
-        start = max(2, page - 2)
-        end = min(total_pages - 1, page + 2)
-        if start > 2:
-            page_numbers.append(None)  # Ellipsis marker
-        page_numbers.extend(range(start, end + 1))
-        if end < total_pages - 1:
-            page_numbers.append(None)  # Ellipsis marker
-        # Show last page
-        if total_pages > 1:
-            page_numbers.append(total_pages)
-    
     return templates.TemplateResponse("materials.html", {
         "request": request,
         "materials": materials,
@@ -171,9 +228,10 @@ async def materials_page(request: Request, page: int = 1, per_page: int = 10, db
         "per_page": per_page,
         "total_count": total_count,
         "total_pages": total_pages,
-        "has_prev": page > 1,
-        "has_next": page < total_pages,
-        "page_numbers": page_numbers
+        "has_prev": result["prev_cursor"] is not None,
+        "has_next": result["next_cursor"] is not None,
+        "prev_cursor": result["prev_cursor"],
+        "next_cursor": result["next_cursor"]
     })
 
 
@@ -214,22 +272,33 @@ async def delete_all_materials_form(request: Request, db = Depends(get_db)):
                 
                 # Delete all BOM lines that reference this material
                 bom_lines = db.collection("product_bom").where("material_id", "==", material_id).stream()
+                affected_products = set()
                 for bom_line in bom_lines:
                     try:
+                        affected_products.add(bom_line.to_dict().get("product_id"))
                         bom_line.reference.delete()
                     except Exception as bom_error:
                         print(f"Warning: Could not delete BOM line {bom_line.id}: {bom_error}")
+                mark_products_stale(db, affected_products)
                 
                 # Delete all purchases that reference this material
                 purchases = db.collection("purchases").where("material_id", "==", material_id).stream()
+                rollup_changes = []
                 for purchase in purchases:
                     try:
                         purchase.reference.delete()
+                        rollup_changes.append(("purchases", purchase.to_dict(), None))
                     except Exception as purchase_error:
                         print(f"Warning: Could not delete purchase {purchase.id}: {purchase_error}")
+                increment_count(db, "purchases", -len(rollup_changes))
                 
                 # Delete material
                 doc_ref.delete()
+                increment_count(db, "materials", -1)
+                record_supplier_changes(db, (((purchase or {}).get("supplier_name"), None) for _, purchase, _ in rollup_changes))
+                rollup_changes.append(("materials", doc.to_dict(), None))
+                record_changes(db, rollup_changes)
+                materials_cache.discard([material_id])
                 deleted_count += 1
                 
             except Exception as e:
@@ -4,7 +4,18 @@ from fastapi.responses import HTMLResponse, RedirectResponse, Response
 from firebase_admin import firestore
 from datetime import datetime
 from io import BytesIO
-from app.database import get_db
+from urllib.parse import urlencode
+from collections import Counter
+from app.database import get_db, get_async_db
+from app.pagination import keyset_query, keyset_page
+from app.counters import increment_count, get_count_async
+from app.cost_snapshots import mark_products_stale, delete_snapshot
+from app.cache import invalidate_dashboard_on_write
+from app.rollups import record_change
+from app.materials_cache import materials_cache
+from app.image_uploads import upload_product_images, register_direct_uploads, next_image_order, release_image
+from app.image_variants import variant_url
+from app.loaders import AsyncDocumentLoader, get_async_loader
 from app import schemas
 from app.jinja_templates import templates
 from app.firestore_models import document_to_dict, datetime_to_timestamp
@@ -12,20 +23,32 @@ from app.storage import storage_client
 from openpyxl import Workbook
 from openpyxl.styles import Font, Alignment, PatternFill
 
-router = APIRouter()
-html_router = APIRouter()
+# Writes through these routers invalidate the cached dashboard
+router = APIRouter(dependencies=[Depends(invalidate_dashboard_on_write)])
+html_router = APIRouter(dependencies=[Depends(invalidate_dashboard_on_write)])
 
 
 @router.get("/", response_model=list[schemas.Product])
-def get_products(skip: int = 0, limit: int = 100, db = Depends(get_db)):
+def get_products(response: Response, skip: int = 0, limit: int = 100, cursor: Optional[str] = None, db = Depends(get_db)):
     products_ref = db.collection("products")
-    docs = products_ref.order_by("created_at", direction=firestore.Query.DESCENDING).offset(skip).limit(limit).stream()
-    products = []
-    for doc in docs:
-        product = document_to_dict(doc)
-        if product:
-            products.append(product)
-    return products
+    if skip:
+        # Legacy offset paging - Firestore still reads every skipped document
+        docs = products_ref.order_by("created_at", direction=firestore.Query.DESCENDING).offset(skip).limit(limit).stream()
+        products = []
+        for doc in docs:
+            product = document_to_dict(doc)
+            if product:
+                products.append(product)
+        return products
+    
+    # Keyset pagination: pass X-Next-Cursor / X-Prev-Cursor back as ?cursor= to move between pages
+    query = keyset_query(products_ref, "created_at", limit, cursor, descending=True)
+    result = keyset_page(query.get(), "created_at", limit, cursor)
+    if result["next_cursor"]:
+        response.headers["X-Next-Cursor"] = result["next_cursor"]
+    if result["prev_cursor"]:
+        response.headers["X-Prev-Cursor"] = result["prev_cursor"]
+    return result["items"]
 
 
 @router.get("/{product_id}", response_model=schemas.Product)
@@ -46,8 +69,11 @@ def create_product(product: schemas.ProductCreate, db = Depends(get_db)):
             data["product_type"] = data["product_type"].value
     data["created_at"] = firestore.SERVER_TIMESTAMP
     doc_ref.set(data)
+    increment_count(db, "products", 1)
     doc = doc_ref.get()
-    return document_to_dict(doc)
+    created = document_to_dict(doc)
+    record_change(db, "products", None, created)
+    return created
 
 
 @router.put("/{product_id}", response_model=schemas.Product)
@@ -64,9 +90,15 @@ def update_product(product_id: str, product: schemas.ProductUpdate, db = Depends
             update_data["product_type"] = update_data["product_type"].value
     if update_data:
         doc_ref.update(update_data)
+        # The cost estimate carries the product name
+        if "name" in update_data and update_data["name"] != (doc.to_dict() or {}).get("name"):
+            mark_products_stale(db, [product_id])
     
     updated_doc = doc_ref.get()
-    return document_to_dict(updated_doc)
+    updated = document_to_dict(updated_doc)
+    if update_data:
+        record_change(db, "products", document_to_dict(doc), updated)
+    return updated
 
 
 @router.delete("/{product_id}")
@@ -84,14 +116,15 @@ def delete_product(product_id: str, db = Depends(get_db)):
     # Delete related images
     images = db.collection("product_images").where("product_id", "==", product_id).stream()
     for image in images:
-        image_data = image.to_dict()
-        if image_data and "image_url" in image_data:
-            # Delete from storage if using GCS
-            storage_client.delete_file(image_data["image_url"])
         image.reference.delete()
+        # Delete the blobs unless another image still shares the same content
+        release_image(db, image.to_dict())
     
     # Delete product
     doc_ref.delete()
+    increment_count(db, "products", -1)
+    record_change(db, "products", doc.to_dict(), None)
+    delete_snapshot(db, product_id)
     return {"message": "Product deleted"}
 
 
@@ -138,6 +171,7 @@ def create_bom_line(product_id: str, bom: schemas.ProductBOMCreate, db = Depends
     data["product_id"] = product_id
     data["unit"] = unit
     doc_ref.set(data)
+    mark_products_stale(db, [product_id])
     doc = doc_ref.get()
     return document_to_dict(doc)
 
@@ -150,51 +184,32 @@ def delete_bom_line(bom_id: str, db = Depends(get_db)):
         raise HTTPException(status_code=404, detail="BOM line not found")
     
     doc_ref.delete()
+    mark_products_stale(db, [(doc.to_dict() or {}).get("product_id")])
     return {"message": "BOM line deleted"}
 
 
 # HTML routes
 @html_router.get("/products", response_class=HTMLResponse)
-async def products_page(request: Request, page: int = 1, per_page: int = 10, db = Depends(get_db)):
-    # Calculate skip
-    skip = (page - 1) * per_page
-    
-    # Get total count
+async def products_page(request: Request, cursor: Optional[str] = None, page: int = 1, per_page: int = 10, db = Depends(get_async_db), loader: AsyncDocumentLoader = Depends(get_async_loader)):
+    # Get total count from the maintained counter
     products_ref = db.collection("products")
-    total_docs = products_ref.stream()
-    total_count = sum(1 for _ in total_docs)
+    total_count = await get_count_async(db, "products")
     
-    # Get paginated products
-    docs = products_ref.order_by("created_at", direction=firestore.Query.DESCENDING).offset(skip).limit(per_page).stream()
-    products = []
-    for doc in docs:
-        product = document_to_dict(doc)
-        if product:
-            products.append(product)
+    # Get one page of products, resuming after the cursor (keyset pagination)
+    query = keyset_query(products_ref, "created_at", per_page, cursor, descending=True)
+    result = keyset_page(await query.get(), "created_at", per_page, cursor)
+    products = result["items"]
+    
+    # Attach cached costs from the product_costs snapshots (one batched read)
+    snapshots = await loader.load_many("product_costs", (p["id"] for p in products))
+    for product in products:
+        snapshot = snapshots.get(product["id"]) or {}
+        product["cost_try"] = snapshot.get("total_try")
+        product["cost_stale"] = bool(snapshot.get("stale"))
     
     # Calculate pagination info
     total_pages = (total_count + per_page - 1) // per_page if total_count > 0 else 1
     
-    # Generate page numbers for pagination (show current page ± 2, plus first and last)
-    page_numbers = []
-    if total_pages <= 7:
-        # Show all pages if 7 or fewer
-        page_numbers = list(range(1, total_pages + 1))
-    else:
-        # Show first page
-        page_numbers.append(1)
-        # Show pages around current
-        start = max(2, page - 2)
-        end = min(total_pages - 1, page + 2)
-        if start > 2:
-            page_numbers.append(None)  # Ellipsis marker
-        page_numbers.extend(range(start, end + 1))
-        if end < total_pages - 1:
-            page_numbers.append(None)  # Ellipsis marker
-        # Show last page
-        if total_pages > 1:
-            page_numbers.append(total_pages)
-    
     return templates.TemplateResponse("products.html", {
         "request": request,
         "products": products,
@@ -202,9 +217,10 @@ async def products_page(request: Request, page: int = 1, per_page: int = 10, db
         "per_page": per_page,
         "total_count": total_count,
         "total_pages": total_pages,
-        "has_prev": page > 1,
-        "has_next": page < total_pages,
-        "page_numbers": page_numbers
+        "has_prev": result["prev_cursor"] is not None,
+        "has_next": result["next_cursor"] is not None,
+        "prev_cursor": result["prev_cursor"],
+        "next_cursor": result["next_cursor"]
     })
 
 
@@ -255,19 +271,20 @@ async def delete_all_products_form(request: Request, db = Depends(get_db)):
                 images = db.collection("product_images").where("product_id", "==", product_id).stream()
                 for image in images:
                     try:
-                        image_data = image.to_dict()
-                        if image_data and "image_url" in image_data:
-                            # Delete from storage if using GCS
-                            try:
-                                storage_client.delete_file(image_data["image_url"])
-                            except Exception as storage_error:
-                                print(f"Warning: Could not delete image from storage: {storage_error}")
                         image.reference.delete()
+                        # Delete the blobs unless another image still shares the same content
+                        try:
+                            release_image(db, image.to_dict())
+                        except Exception as storage_error:
+                            print(f"Warning: Could not delete image from storage: {storage_error}")
                     except Exception as image_error:
                         print(f"Warning: Could not delete image {image.id}: {image_error}")
                 
                 # Delete product
                 doc_ref.delete()
+                increment_count(db, "products", -1)
+                record_change(db, "products", doc.to_dict(), None)
+                delete_snapshot(db, product_id)
                 deleted_count += 1
                 
             except Exception as e:
@@ -293,8 +310,8 @@ async def delete_all_products_form(request: Request, db = Depends(get_db)):
 
 
 @html_router.get("/products/{product_id}", response_class=HTMLResponse)
-async def product_detail_page(request: Request, product_id: str, db = Depends(get_db)):
-    doc = db.collection("products").document(product_id).get()
+async def product_detail_page(request: Request, product_id: str, db = Depends(get_async_db), loader: AsyncDocumentLoader = Depends(get_async_loader)):
+    doc = await db.collection("products").document(product_id).get()
     if not doc.exists:
         raise HTTPException(status_code=404, detail="Product not found")
     product = document_to_dict(doc)
@@ -303,54 +320,35 @@ async def product_detail_page(request: Request, product_id: str, db = Depends(ge
     bom_ref = db.collection("product_bom")
     bom_docs = bom_ref.where("product_id", "==", product_id).stream()
     bom_lines = []
-    for bom_doc in bom_docs:
+    async for bom_doc in bom_docs:
         bom = document_to_dict(bom_doc)
         if bom:
-            # Get material name
-            material_doc = db.collection("materials").document(bom["material_id"]).get()
-            if material_doc.exists:
-                material = document_to_dict(material_doc)
-                bom["material_name"] = material["name"] if material else "Unknown"
-            else:
-                bom["material_name"] = "Unknown"
-            
-            # Get purchase info
-            purchase_doc = db.collection("purchases").document(bom["purchase_id"]).get()
-            if purchase_doc.exists:
-                purchase = document_to_dict(purchase_doc)
-                if purchase:
-                    purchase_date = purchase.get("purchase_date")
-                    if purchase_date:
-                        if hasattr(purchase_date, 'strftime'):
-                            date_str = purchase_date.strftime('%Y-%m-%d')
-                        else:
-                            date_str = str(purchase_date)
-                    else:
-                        date_str = "Unknown"
-                    bom["purchase_info"] = f"{purchase['supplier_name']} - {purchase['unit_cost']} {purchase['currency']} ({date_str})"
-                else:
-                    bom["purchase_info"] = "Unknown"
-            else:
-                bom["purchase_info"] = "Unknown"
             bom_lines.append(bom)
     
-    # Get materials for dropdown
-    materials_ref = db.collection("materials")
-    mat_docs = materials_ref.order_by("name").stream()
-    materials = []
-    for mat_doc in mat_docs:
-        material = document_to_dict(mat_doc)
-        if material:
-            materials.append(material)
-    
-    # Get all purchases for the materials dropdown
-    purchases_ref = db.collection("purchases")
-    purchase_docs = purchases_ref.order_by("purchase_date", direction=firestore.Query.DESCENDING).stream()
-    purchases = []
-    for purchase_doc in purchase_docs:
-        purchase = document_to_dict(purchase_doc)
+    # Resolve referenced purchases in one batched read; materials come from the in-memory cache
+    loader.prime("purchases", (bom.get("purchase_id") for bom in bom_lines))
+    for bom in bom_lines:
+        # Get material name
+        material = materials_cache.get(bom.get("material_id"))
+        bom["material_name"] = material["name"] if material else "Unknown"
+        
+        # Get purchase info
+        purchase = await loader.load("purchases", bom.get("purchase_id"))
         if purchase:
-            purchases.append(purchase)
+            purchase_date = purchase.get("purchase_date")
+            if purchase_date:
+                if hasattr(purchase_date, 'strftime'):
+                    date_str = purchase_date.strftime('%Y-%m-%d')
+                else:
+                    date_str = str(purchase_date)
+            else:
+                date_str = "Unknown"
+            bom["purchase_info"] = f"{purchase['supplier_name']} - {purchase['unit_cost']} {purchase['currency']} ({date_str})"
+        else:
+            bom["purchase_info"] = "Unknown"
+    
+    # The "add BOM line" material/purchase pickers load on demand from
+    # /api/materials/search and /api/materials/{id}/purchases
     
     # Get product images - fetch without order_by to avoid index requirement, then sort in Python
     images_ref = db.collection("product_images")
@@ -358,19 +356,25 @@ async def product_detail_page(request: Request, product_id: str, db = Depends(ge
     product_images = []
     print(f"Debug: Fetching images for product_id: {product_id}")
     image_count = 0
-    for image_doc in image_docs:
+    async for image_doc in image_docs:
         image = document_to_dict(image_doc)
         if image:
             image_count += 1
-            # Generate signed URL for the image if needed
-            original_url = image.get('image_url', '')
-            if original_url:
-                # Try to get signed URL for better access
-                signed_url = storage_client.get_signed_url(original_url)
-                image['image_url'] = signed_url
             print(f"Debug: Found image {image_count}: id={image.get('id')}, url={image.get('image_url', 'N/A')[:80]}..., order={image.get('order', 'N/A')}")
             product_images.append(image)
     print(f"Debug: Total images found: {len(product_images)}")
+    # Smallest suitable derivative for the carousel and the thumbnail strip (original if none)
+    for image in product_images:
+        image['display_url'] = variant_url(image, 500)
+        image['thumb_url'] = variant_url(image, 80)
+    # Signed URLs for the whole gallery at once (served from the signed URL cache after the first view)
+    url_fields = ('image_url', 'display_url', 'thumb_url')
+    signed_urls = iter(storage_client.get_signed_urls([image.get(field, '') for image in product_images for field in url_fields]))
+    for image in product_images:
+        for field in url_fields:
+            signed_url = next(signed_urls)
+            if signed_url:
+                image[field] = signed_url
     # Sort by order, then by created_at if order is the same (sorting in Python)
     def sort_key(x):
         order = x.get("order", 0)
@@ -394,8 +398,6 @@ async def product_detail_page(request: Request, product_id: str, db = Depends(ge
             "request": request,
             "product": product,
             "bom_lines": bom_lines,
-            "materials": materials,
-            "purchases": purchases,
             "product_images": product_images
         }
     )
@@ -507,87 +509,23 @@ async def create_product_form(
         import traceback
         traceback.print_exc()
     
-    # Upload images if provided
+    # Upload images if provided (concurrently, recorded in one batch)
+    redirect_url = f"/products/{product_id}"
     if image_files:
         print(f"Uploading {len(image_files)} image(s) for product {product_id} (SKU: {sku})")
-        uploaded_files = []
         try:
-            images_ref = db.collection("product_images")
-            image_docs = images_ref.where("product_id", "==", product_id).stream()
-            max_order = -1
-            for image_doc in image_docs:
-                image_data = image_doc.to_dict()
-                if image_data and "order" in image_data:
-                    max_order = max(max_order, image_data["order"])
-            
-            for idx, image_file in enumerate(image_files):
-                try:
-                    if not image_file.filename or not image_file.filename.strip():
-                        print(f"⚠ Warning: Skipping file with empty filename at index {idx}")
-                        continue
-                    
-                    print(f"Debug: Processing image {idx + 1}/{len(image_files)}: {image_file.filename}")
-                    
-                    # Check if storage is available
-                    if not storage_client.bucket:
-                        print(f"⚠ Warning: Firebase Storage not configured. Skipping image upload for {image_file.filename}")
-                        print(f"Hint: Set FIREBASE_STORAGE_BUCKET in your .env file")
-                        continue
-                    
-                    # Read file content - IMPORTANT: Reset file pointer if needed
-                    # FastAPI UploadFile can only be read once, so we need to read it here
-                    try:
-                        # Reset to beginning if possible
-                        if hasattr(image_file.file, 'seek'):
-                            image_file.file.seek(0)
-                        file_content = await image_file.read()
-                        print(f"Debug: Read {len(file_content)} bytes from {image_file.filename}")
-                    except Exception as read_error:
-                        print(f"✗ Error reading file {image_file.filename}: {read_error}")
-                        continue
-                    
-                    # Determine content type
-                    content_type = image_file.content_type or "image/jpeg"
-                    print(f"Debug: Content type: {content_type}")
-                    
-                    # Upload to Firebase Storage - organize by SKU
-                    image_url = storage_client.upload_file(
-                        file_content, 
-                        image_file.filename, 
-                        content_type,
-                        sku=sku  # Pass SKU to organize files in subfolder
-                    )
-                    
-                    if image_url:
-                        # Create product image record
-                        doc_ref = db.collection("product_images").document()
-                        data = {
-                            "product_id": product_id,
-                            "image_url": image_url,
-                            "order": max_order + 1 + idx,
-                            "created_at": firestore.SERVER_TIMESTAMP
-                        }
-                        doc_ref.set(data)
-                        uploaded_files.append(image_file.filename)
-                        print(f"✓ Successfully uploaded and saved image {idx + 1}: {image_file.filename} -> {image_url}")
-                    else:
-                        print(f"⚠ Warning: upload_file returned None for {image_file.filename}")
-                except Exception as e:
-                    print(f"✗ Error uploading image {image_file.filename}: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    # Continue with other images even if one fails
-                    continue
-            
-            if uploaded_files:
-                print(f"✓ Successfully uploaded {len(uploaded_files)} image(s): {', '.join(uploaded_files)}")
+            results = await upload_product_images(db, product_id, image_files)
+            failed = [r["filename"] or "(unnamed)" for r in results if r["status"] != "uploaded"]
         except Exception as e:
             print(f"✗ Error processing images: {e}")
             import traceback
             traceback.print_exc()
             # Don't fail the entire product creation if images fail
+            failed = [f.filename or "(unnamed)" for f in image_files]
+        if failed:
+            redirect_url += "?" + urlencode({"image_upload_failed": ", ".join(failed)})
     
-    return RedirectResponse(url=f"/products/{product_id}", status_code=303)
+    return RedirectResponse(url=redirect_url, status_code=303)
 
 
 @html_router.post("/products/{product_id}", response_class=HTMLResponse)
@@ -677,6 +615,8 @@ def bulk_update_product_counts(request: schemas.BulkCountUpdateRequest, db = Dep
         doc = doc_ref.get()
         if doc.exists:
             doc_ref.update({"count": count})
+            old_data = doc.to_dict()
+            record_change(db, "products", old_data, {**(old_data or {}), "count": count})
             updated_count += 1
         else:
             raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
@@ -714,20 +654,11 @@ async def add_product_image(
     if not product_doc.exists:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    # Get the highest order number for this product
-    images_ref = db.collection("product_images")
-    image_docs = images_ref.where("product_id", "==", product_id).stream()
-    max_order = -1
-    for image_doc in image_docs:
-        image_data = image_doc.to_dict()
-        if image_data and "order" in image_data:
-            max_order = max(max_order, image_data["order"])
-    
     doc_ref = db.collection("product_images").document()
     data = {
         "product_id": product_id,
         "image_url": image_url,
-        "order": max_order + 1,
+        "order": next_image_order(db, product_id),
         "created_at": firestore.SERVER_TIMESTAMP
     }
     doc_ref.set(data)
@@ -735,6 +666,35 @@ async def add_product_image(
     return document_to_dict(doc)
 
 
+@router.post("/{product_id}/image-uploads", response_model=list[schemas.DirectUploadTicket])
+def create_image_uploads(product_id: str, request: schemas.DirectUploadRequest, db = Depends(get_db)):
+    """Signed PUT URLs so the browser can upload images straight to the bucket"""
+    product_doc = db.collection("products").document(product_id).get()
+    if not product_doc.exists:
+        raise HTTPException(status_code=404, detail="Product not found")
+    if not storage_client.bucket:
+        raise HTTPException(status_code=503, detail="Firebase Storage not configured (set FIREBASE_STORAGE_BUCKET)")
+    
+    tickets = []
+    for upload in request.files:
+        if not upload.content_type.startswith("image/"):
+            raise HTTPException(status_code=400, detail=f"{upload.filename} is not an image")
+        ticket = storage_client.create_upload_url(product_id, upload.filename, upload.content_type)
+        tickets.append({"filename": upload.filename, **ticket})
+    return tickets
+
+
+@router.post("/{product_id}/images/finalize")
+def finalize_image_uploads(product_id: str, request: schemas.FinalizeUploadsRequest, db = Depends(get_db)):
+    """Record images uploaded through /image-uploads once their PUTs have completed"""
+    product_doc = db.collection("products").document(product_id).get()
+    if not product_doc.exists:
+        raise HTTPException(status_code=404, detail="Product not found")
+    
+    results = register_direct_uploads(db, product_id, [u.model_dump() for u in request.uploads])
+    return {"results": results}
+
+
 @router.delete("/images/{image_id}")
 def delete_product_image(image_id: str, db = Depends(get_db)):
     """Delete a product image"""
@@ -743,12 +703,9 @@ def delete_product_image(image_id: str, db = Depends(get_db)):
     if not doc.exists:
         raise HTTPException(status_code=404, detail="Image not found")
     
-    image_data = doc.to_dict()
-    if image_data and "image_url" in image_data:
-        # Delete from storage if using GCS
-        storage_client.delete_file(image_data["image_url"])
-    
     doc_ref.delete()
+    # Delete the blobs unless another image still shares the same content
+    release_image(db, doc.to_dict())
     return {"message": "Image deleted"}
 
 
@@ -780,12 +737,12 @@ async def delete_product_image_form(
 
 
 @html_router.get("/products/export/excel")
-async def export_products_excel(db = Depends(get_db)):
+async def export_products_excel(db = Depends(get_async_db)):
     """Export all products to Excel file"""
     products_ref = db.collection("products")
     docs = products_ref.order_by("created_at", direction=firestore.Query.DESCENDING).stream()
     products = []
-    for doc in docs:
+    async for doc in docs:
         product = document_to_dict(doc)
         if product:
             products.append(product)
@@ -822,13 +779,14 @@ async def export_products_excel(db = Depends(get_db)):
         cell.font = header_font
         cell.alignment = header_alignment
     
+    # Count BOM lines per product in one pass over product_bom (the export covers every product)
+    bom_counts = Counter()
+    async for bom_doc in db.collection("product_bom").select(["product_id"]).stream():
+        bom_counts[(bom_doc.to_dict() or {}).get("product_id")] += 1
+    
     # Write data rows
     for row_num, product in enumerate(products, 2):
-        # Get BOM count
-        bom_ref = db.collection("product_bom")
-        bom_docs = bom_ref.where("product_id", "==", product["id"]).stream()
-        bom_count = sum(1 for _ in bom_docs)
-        
+        bom_count = bom_counts[product["id"]]
         # Handle datetime
         created_at = product.get("created_at")
         if created_at:
@@ -1,29 +1,56 @@
-from fastapi import APIRouter, Depends, HTTPException, Request, Form
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Form
+from typing import Optional
 from fastapi.responses import HTMLResponse, RedirectResponse, Response
 from firebase_admin import firestore
 from datetime import datetime
 from io import BytesIO
-from app.database import get_db
+from app.database import get_db, get_async_db
+from app.pagination import keyset_query, keyset_page
+from app.counters import increment_count, get_count_async
+from app.cost_snapshots import mark_products_stale, products_referencing
+from app.cache import invalidate_dashboard_on_write
+from app.rollups import record_change
+from app.materials_cache import materials_cache
+from app.suppliers import record_supplier_change, load_suppliers, search_suppliers
 from app import schemas
 from app.jinja_templates import templates
 from app.firestore_models import document_to_dict
 from openpyxl import Workbook
 from openpyxl.styles import Font, Alignment, PatternFill
 
-router = APIRouter()
-html_router = APIRouter()
+# Writes through these routers invalidate the cached dashboard
+router = APIRouter(dependencies=[Depends(invalidate_dashboard_on_write)])
+html_router = APIRouter(dependencies=[Depends(invalidate_dashboard_on_write)])
 
 
 @router.get("/", response_model=list[schemas.Purchase])
-def get_purchases(skip: int = 0, limit: int = 100, db = Depends(get_db)):
+def get_purchases(response: Response, skip: int = 0, limit: int = 100, cursor: Optional[str] = None, db = Depends(get_db)):
     purchases_ref = db.collection("purchases")
-    docs = purchases_ref.order_by("purchase_date", direction=firestore.Query.DESCENDING).offset(skip).limit(limit).stream()
-    purchases = []
-    for doc in docs:
-        purchase = document_to_dict(doc)
-        if purchase:
-            purchases.append(purchase)
-    return purchases
+    if skip:
+        # Legacy offset paging - Firestore still reads every skipped document
+        docs = purchases_ref.order_by("purchase_date", direction=firestore.Query.DESCENDING).offset(skip).limit(limit).stream()
+        purchases = []
+        for doc in docs:
+            purchase = document_to_dict(doc)
+            if purchase:
+                purchases.append(purchase)
+        return purchases
+    
+    # Keyset pagination: pass X-Next-Cursor / X-Prev-Cursor back as ?cursor= to move between pages
+    query = keyset_query(purchases_ref, "purchase_date", limit, cursor, descending=True)
+    result = keyset_page(query.get(), "purchase_date", limit, cursor)
+    if result["next_cursor"]:
+        response.headers["X-Next-Cursor"] = result["next_cursor"]
+    if result["prev_cursor"]:
+        response.headers["X-Prev-Cursor"] = result["prev_cursor"]
+    return result["items"]
+
+
+# Defined before /{purchase_id} so "suppliers" isn't taken as a purchase ID
+@router.get("/suppliers", response_model=list[schemas.Supplier])
+def get_suppliers(q: str = "", limit: int = Query(10, ge=1, le=100), db = Depends(get_db)):
+    """Supplier typeahead: names starting with q, most used first"""
+    return search_suppliers(db, q, limit)
 
 
 @router.get("/{purchase_id}", response_model=schemas.Purchase)
@@ -48,8 +75,12 @@ def create_purchase(purchase: schemas.PurchaseCreate, db = Depends(get_db)):
         data["qty_remaining"] = data["qty_purchased"]
     data["created_at"] = firestore.SERVER_TIMESTAMP
     doc_ref.set(data)
+    increment_count(db, "purchases", 1)
     doc = doc_ref.get()
-    return document_to_dict(doc)
+    created = document_to_dict(doc)
+    record_change(db, "purchases", None, created)
+    record_supplier_change(db, None, created.get("supplier_name"))
+    return created
 
 
 @router.put("/{purchase_id}", response_model=schemas.Purchase)
@@ -67,9 +98,17 @@ def update_purchase(purchase_id: str, purchase: schemas.PurchaseUpdate, db = Dep
     update_data = purchase.model_dump(exclude_unset=True)
     if update_data:
         doc_ref.update(update_data)
+        # Only cost-relevant changes invalidate the cost snapshots of products using this purchase
+        old_data = doc.to_dict() or {}
+        if any(field in update_data and update_data[field] != old_data.get(field) for field in ("unit_cost", "currency", "purchase_date")):
+            mark_products_stale(db, products_referencing(db, "purchase_id", purchase_id))
     
     updated_doc = doc_ref.get()
-    return document_to_dict(updated_doc)
+    updated = document_to_dict(updated_doc)
+    if update_data:
+        record_change(db, "purchases", document_to_dict(doc), updated)
+        record_supplier_change(db, (doc.to_dict() or {}).get("supplier_name"), updated.get("supplier_name"))
+    return updated
 
 
 @router.delete("/{purchase_id}")
@@ -85,58 +124,33 @@ def delete_purchase(purchase_id: str, db = Depends(get_db)):
         raise HTTPException(status_code=400, detail="Cannot delete purchase: it is referenced by BOM lines")
     
     doc_ref.delete()
+    increment_count(db, "purchases", -1)
+    record_change(db, "purchases", doc.to_dict(), None)
+    record_supplier_change(db, (doc.to_dict() or {}).get("supplier_name"), None)
     return {"message": "Purchase deleted"}
 
 
 # HTML routes
 @html_router.get("/purchases", response_class=HTMLResponse)
-async def purchases_page(request: Request, page: int = 1, per_page: int = 10, db = Depends(get_db)):
-    # Calculate skip
-    skip = (page - 1) * per_page
-    
-    # Get total count
+async def purchases_page(request: Request, cursor: Optional[str] = None, page: int = 1, per_page: int = 10, db = Depends(get_async_db)):
+    # Get total count from the maintained counter
     purchases_ref = db.collection("purchases")
-    total_docs = purchases_ref.stream()
-    total_count = sum(1 for _ in total_docs)
+    total_count = await get_count_async(db, "purchases")
     
-    # Get paginated purchases
-    docs = purchases_ref.order_by("purchase_date", direction=firestore.Query.DESCENDING).offset(skip).limit(per_page).stream()
-    purchases = []
-    for doc in docs:
-        purchase = document_to_dict(doc)
-        if purchase:
-            # Get material name
-            material_doc = db.collection("materials").document(purchase["material_id"]).get()
-            if material_doc.exists:
-                material = document_to_dict(material_doc)
-                purchase["material_name"] = material["name"] if material else "Unknown"
-            else:
-                purchase["material_name"] = "Unknown"
-            purchases.append(purchase)
+    # Get one page of purchases, resuming after the cursor (keyset pagination)
+    query = keyset_query(purchases_ref, "purchase_date", per_page, cursor, descending=True)
+    result = keyset_page(await query.get(), "purchase_date", per_page, cursor)
+    purchases = result["items"]
+    
+    # Material names come from the in-memory materials cache
+    materials = materials_cache.get_many(p.get("material_id") for p in purchases)
+    for purchase in purchases:
+        material = materials.get(purchase.get("material_id"))
+        purchase["material_name"] = material["name"] if material else "Unknown"
     
     # Calculate pagination info
     total_pages = (total_count + per_page - 1) // per_page if total_count > 0 else 1
     
-    # Generate page numbers for pagination (show current page ± 2, plus first and last)
-    page_numbers = []
-    if total_pages <= 7:
-        # Show all pages if 7 or fewer
-        page_numbers = list(range(1, total_pages + 1))
-    else:
-        # Show first page
-        page_numbers.append(1)
-        # Show pages around current
-        start = max(2, page - 2)
-        end = min(total_pages - 1, page + 2)
-        if start > 2:
-            page_numbers.append(None)  # Ellipsis marker
-        page_numbers.extend(range(start, end + 1))
-        if end < total_pages - 1:
-            page_numbers.append(None)  # Ellipsis marker
-        # Show last page
-        if total_pages > 1:
-            page_numbers.append(total_pages)
-    
     return templates.TemplateResponse("purchases.html", {
         "request": request,
         "purchases": purchases,
@@ -144,9 +158,10 @@ async def purchases_page(request: Request, page: int = 1, per_page: int = 10, db
         "per_page": per_page,
         "total_count": total_count,
         "total_pages": total_pages,
-        "has_prev": page > 1,
-        "has_next": page < total_pages,
-        "page_numbers": page_numbers
+        "has_prev": result["prev_cursor"] is not None,
+        "has_next": result["next_cursor"] is not None,
+        "prev_cursor": result["prev_cursor"],
+        "next_cursor": result["next_cursor"]
     })
 
 
@@ -198,6 +213,9 @@ async def delete_all_purchases_form(request: Request, db = Depends(get_db)):
                 
                 # Delete purchase
                 doc_ref.delete()
+                increment_count(db, "purchases", -1)
+                record_change(db, "purchases", doc.to_dict(), None)
+                record_supplier_change(db, (doc.to_dict() or {}).get("supplier_name"), None)
                 deleted_count += 1
                 
             except Exception as e:
@@ -224,22 +242,10 @@ async def delete_all_purchases_form(request: Request, db = Depends(get_db)):
 
 @html_router.get("/purchases/new", response_class=HTMLResponse)
 async def new_purchase_page(request: Request, db = Depends(get_db)):
-    materials_ref = db.collection("materials")
-    docs = materials_ref.order_by("name").stream()
-    materials = []
-    for doc in docs:
-        material = document_to_dict(doc)
-        if material:
-            materials.append(material)
+    materials = materials_cache.all()
     
-    # Get unique supplier names from previous purchases
-    purchases_ref = db.collection("purchases")
-    supplier_set = set()
-    for purchase_doc in purchases_ref.stream():
-        purchase = purchase_doc.to_dict()
-        if purchase and "supplier_name" in purchase:
-            supplier_set.add(purchase["supplier_name"])
-    supplier_list = sorted(list(supplier_set))
+    # Supplier names from the maintained supplier index (one read)
+    supplier_list = [supplier["name"] for supplier in load_suppliers(db)]
     
     return templates.TemplateResponse("purchase_form.html", {
         "request": request, 
@@ -256,22 +262,10 @@ async def edit_purchase_page(request: Request, purchase_id: str, db = Depends(ge
         raise HTTPException(status_code=404, detail="Purchase not found")
     purchase = document_to_dict(doc)
     
-    materials_ref = db.collection("materials")
-    docs = materials_ref.order_by("name").stream()
-    materials = []
-    for mat_doc in docs:
-        material = document_to_dict(mat_doc)
-        if material:
-            materials.append(material)
+    materials = materials_cache.all()
     
-    # Get unique supplier names from previous purchases
-    purchases_ref = db.collection("purchases")
-    supplier_set = set()
-    for purchase_doc in purchases_ref.stream():
-        purchase_data = purchase_doc.to_dict()
-        if purchase_data and "supplier_name" in purchase_data:
-            supplier_set.add(purchase_data["supplier_name"])
-    supplier_list = sorted(list(supplier_set))
+    # Supplier names from the maintained supplier index (one read)
+    supplier_list = [supplier["name"] for supplier in load_suppliers(db)]
     
     return templates.TemplateResponse("purchase_form.html", {
         "request": request, 
@@ -347,12 +341,12 @@ async def update_purchase_form(
 
 
 @html_router.get("/purchases/export/excel")
-async def export_purchases_excel(db = Depends(get_db)):
+async def export_purchases_excel(db = Depends(get_async_db)):
     """Export all purchases to Excel file"""
     purchases_ref = db.collection("purchases")
     docs = purchases_ref.order_by("purchase_date", direction=firestore.Query.DESCENDING).stream()
     purchases = []
-    for doc in docs:
+    async for doc in docs:
         purchase = document_to_dict(doc)
         if purchase:
             purchases.append(purchase)
@@ -391,13 +385,14 @@ async def export_purchases_excel(db = Depends(get_db)):
         cell.font = header_font
         cell.alignment = header_alignment
     
+    # Material info for all purchases from the in-memory materials cache
+    materials = materials_cache.get_many(p.get("material_id") for p in purchases)
+    
     # Write data rows
     for row_num, purchase in enumerate(purchases, 2):
-        # Get material info
-        material_doc = db.collection("materials").document(purchase["material_id"]).get()
-        if material_doc.exists:
-            material = document_to_dict(material_doc)
-            material_name = material["name"] if material else "Unknown"
+        material = materials.get(purchase.get("material_id"))
+        if material:
+            material_name = material["name"]
             material_type = material.get("type", "Unknown")
             material_unit = material.get("unit", "")
         else:
@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Union, Literal
 from app.models import MaterialType, ProductType
 
 
@@ -115,11 +115,38 @@ class ProductImage(ProductImageBase):
     id: str
     product_id: str
     created_at: datetime
+    variants: Optional[Dict[str, Any]] = None  # name -> {"url", "width", "height"}
 
     class Config:
         from_attributes = True
 
 
+class DirectUploadFile(BaseModel):
+    filename: str
+    content_type: str = "image/jpeg"
+
+
+class DirectUploadRequest(BaseModel):
+    files: list[DirectUploadFile]
+
+
+class DirectUploadTicket(BaseModel):
+    filename: str
+    blob_name: str
+    upload_url: str
+    headers: Dict[str, str]
+    expires_at: datetime
+
+
+class FinalizedUpload(BaseModel):
+    blob_name: str
+    filename: Optional[str] = None
+
+
+class FinalizeUploadsRequest(BaseModel):
+    uploads: list[FinalizedUpload]
+
+
 class BulkCountUpdate(BaseModel):
     product_id: str
     count: int
@@ -194,3 +221,13 @@ class CostEstimate(BaseModel):
     total_try: Optional[float] = None
     exchange_rates: list[ExchangeRateInfo] = []
     has_missing_costs: bool
+
+
+class Supplier(BaseModel):
+    name: str
+    count: int
+    last_used: Optional[datetime] = None
+
+
+class BatchCostEstimateRequest(BaseModel):
+    product_ids: Union[list[str], Literal["all"]] = "all"
@@ -1,18 +1,86 @@
 import os
 from firebase_admin import storage
-from typing import Optional
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from typing import Optional, Union, BinaryIO, Dict, Any, Callable
+from io import BytesIO
 import uuid
-from datetime import timedelta
+import hashlib
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
+from app import image_variants
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Signed GET URLs are valid for 10 years and re-signed once within a day of expiring
+SIGNED_URL_EXPIRATION = timedelta(days=3650)
+SIGNED_URL_REFRESH_MARGIN = timedelta(days=1)
+# Signed PUT URLs for direct browser uploads are short-lived
+DIRECT_UPLOAD_URL_EXPIRATION = timedelta(minutes=int(os.getenv("DIRECT_UPLOAD_URL_MINUTES", "15")))
+
+
+# Uploads above UPLOAD_CHUNK_SIZE are sent as resumable uploads in chunks of that size
+# (must be a multiple of 256 KB); anything over UPLOAD_MAX_BYTES is rejected while streaming
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(25 * 1024 * 1024)))
+
+
+class FileTooLarge(ValueError):
+    """Raised when an upload exceeds UPLOAD_MAX_BYTES"""
+
+
+class _SizeCappedReader:
+    """Read-through wrapper that fails once more than max_bytes have been read"""
+
+    def __init__(self, stream: BinaryIO, max_bytes: int, filename: str):
+        self._stream = stream
+        self._max_bytes = max_bytes
+        self._filename = filename
+        try:
+            self._start = stream.tell()
+        except (AttributeError, OSError):
+            self._start = 0
+        self._read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._stream.read(size)
+        self._read += len(chunk)
+        if self._read > self._max_bytes:
+            raise FileTooLarge(f"{self._filename} is larger than {self._max_bytes} bytes")
+        return chunk
+
+    def tell(self) -> int:
+        return self._stream.tell()
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        position = self._stream.seek(offset, whence)
+        self._read = max(position - self._start, 0)
+        return position
+
+
+def _remaining_size(stream: BinaryIO) -> Optional[int]:
+    """Bytes left to read in a seekable stream, or None if it can't be measured"""
+    try:
+        position = stream.tell()
+        end = stream.seek(0, os.SEEK_END)
+        stream.seek(position)
+        return end - position
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
 class FirebaseStorage:
     def __init__(self):
         self.bucket_name = os.getenv("FIREBASE_STORAGE_BUCKET")
         self._bucket = None  # Lazy initialization
         self._initialized = False
+        # blob name -> (signed URL, expires_at epoch seconds), least recently used first
+        self.signed_url_cache_size = int(os.getenv("SIGNED_URL_CACHE_SIZE", "2048"))
+        self._signed_urls: OrderedDict = OrderedDict()
+        self._signed_url_lock = threading.Lock()
     
     def _ensure_bucket(self):
         """Lazy initialization of bucket - only when needed"""
@@ -56,39 +124,59 @@ class FirebaseStorage:
         """Get bucket with lazy initialization"""
         return self._ensure_bucket()
     
-    def upload_file(self, file_content: bytes, filename: str, content_type: str = "image/jpeg", sku: Optional[str] = None) -> Optional[str]:
+    @staticmethod
+    def _unique_blob_name(filename: str, sku: Optional[str] = None) -> str:
+        # Generate unique filename - organize by SKU if provided
+        if sku:
+            # Sanitize SKU for use in path (remove special characters)
+            safe_sku = "".join(c if c.isalnum() or c in ('-', '_') else '_' for c in sku)
+            return f"product_images/{safe_sku}/{uuid.uuid4()}_{filename}"
+        return f"product_images/{uuid.uuid4()}_{filename}"
+    
+    def upload_file(
+        self,
+        file_content: Union[bytes, BinaryIO],
+        filename: str,
+        content_type: str = "image/jpeg",
+        sku: Optional[str] = None,
+        blob_name: Optional[str] = None
+    ) -> Optional[str]:
         """Upload file to Firebase Storage and return signed URL
         
+        File-like objects are streamed rather than loaded into memory: anything
+        larger than UPLOAD_CHUNK_SIZE (or of unknown size) goes up as a
+        chunked resumable upload. Uploads over UPLOAD_MAX_BYTES are aborted
+        while streaming and raise FileTooLarge.
+        
         Args:
-            file_content: File content as bytes
+            file_content: File content as bytes, or a readable binary file object
             filename: Original filename
             content_type: MIME type of the file
             sku: Product SKU to organize files in subfolder (optional)
+            blob_name: Exact blob path to write (default: a unique name under product_images/)
         """
         bucket = self.bucket  # This will trigger lazy initialization
         if not bucket:
             return None
         
+        if isinstance(file_content, (bytes, bytearray)):
+            file_content = BytesIO(file_content)
+        
         try:
-            # Generate unique filename - organize by SKU if provided
-            if sku:
-                # Sanitize SKU for use in path (remove special characters)
-                safe_sku = "".join(c if c.isalnum() or c in ('-', '_') else '_' for c in sku)
-                unique_filename = f"product_images/{safe_sku}/{uuid.uuid4()}_{filename}"
-            else:
-                unique_filename = f"product_images/{uuid.uuid4()}_{filename}"
-            blob = bucket.blob(unique_filename)
+            unique_filename = blob_name or self._unique_blob_name(filename, sku)
+            size = _remaining_size(file_content)
+            if size is not None and size > UPLOAD_MAX_BYTES:
+                raise FileTooLarge(f"{filename} is larger than {UPLOAD_MAX_BYTES} bytes")
             
-            blob.upload_from_string(file_content, content_type=content_type)
+            blob = bucket.blob(unique_filename)
+            if size is None or size > UPLOAD_CHUNK_SIZE:
+                # Resumable upload, sent UPLOAD_CHUNK_SIZE bytes at a time
+                blob.chunk_size = UPLOAD_CHUNK_SIZE
+            blob.upload_from_file(_SizeCappedReader(file_content, UPLOAD_MAX_BYTES, filename), content_type=content_type, size=size)
             
             # Generate signed URL (valid for 10 years) - this works with uniform bucket-level access
             try:
-                signed_url = blob.generate_signed_url(
-                    expiration=timedelta(days=3650),  # 10 years
-                    method='GET'
-                )
-                print(f"Debug: Generated signed URL (valid for 10 years)")
-                return signed_url
+                return self._sign(bucket, unique_filename)
             except Exception as e:
                 print(f"Debug: Could not generate signed URL: {e}")
                 # Fallback: Try Firebase Storage public URL format
@@ -97,70 +185,275 @@ class FirebaseStorage:
                 public_url = f"https://firebasestorage.googleapis.com/v0/b/{self.bucket_name}/o/{encoded_path}?alt=media"
                 print(f"Debug: Using Firebase Storage URL format: {public_url}")
                 return public_url
+        except FileTooLarge:
+            raise
         except Exception as e:
             print(f"Error uploading to Firebase Storage: {e}")
             import traceback
             traceback.print_exc()
             return None
     
+    @staticmethod
+    def _content_hash(stream: BinaryIO) -> str:
+        """SHA-256 of a seekable stream's remaining bytes, read in chunks; the position is restored"""
+        position = stream.tell()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+            digest.update(chunk)
+        stream.seek(position)
+        return digest.hexdigest()
+    
+    @staticmethod
+    def content_blob_name(content_hash: str) -> str:
+        """Blob path of an image stored under its content hash"""
+        return f"product_images/sha256/{content_hash}"
+    
+    def upload_image(
+        self,
+        file_content: Union[bytes, BinaryIO],
+        filename: str,
+        content_type: str = "image/jpeg",
+        claim: Optional[Callable[[str], bool]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Store an image under the SHA-256 of its content, plus resized WebP derivatives
+        
+        Identical content always maps to the same blob, so an image that is
+        already in the bucket is not uploaded again and its derivatives are
+        reused. Derivatives are rendered on the image process pool and stored
+        next to the original as <original>_<variant>.webp, with their size in
+        the blob metadata; a derivative that fails is just left out.
+        
+        Args:
+            file_content: Image bytes, or a seekable binary file object
+            filename: Original filename (for messages only)
+            content_type: MIME type of the file
+            claim: Called with the content hash before the bucket is checked; takes a
+                reference on the content and returns whether existing blobs may be
+                reused. When it returns False (nothing referenced the content, so a
+                delete may be in flight) the blobs are always written again.
+        
+        Returns:
+            {"image_url", "content_hash", "deduplicated", "variants": {name: {"url", "width", "height"}}},
+            or None if the original could not be uploaded
+        """
+        bucket = self.bucket  # This will trigger lazy initialization
+        if not bucket:
+            return None
+        if isinstance(file_content, (bytes, bytearray)):
+            file_content = BytesIO(file_content)
+        
+        size = _remaining_size(file_content)
+        if size is not None and size > UPLOAD_MAX_BYTES:
+            raise FileTooLarge(f"{filename} is larger than {UPLOAD_MAX_BYTES} bytes")
+        content_hash = self._content_hash(file_content)
+        blob_name = self.content_blob_name(content_hash)
+        
+        reusable = claim(content_hash) if claim else True
+        deduplicated = reusable and bucket.blob(blob_name).exists()
+        if deduplicated:
+            image_url = self._sign(bucket, blob_name)
+        else:
+            image_url = self.upload_file(file_content, filename, content_type, blob_name=blob_name)
+            if not image_url:
+                return None
+        
+        variants = {}
+        if content_type.startswith("image/"):
+            variant_blobs = {
+                name: f"{blob_name}_{name}.{image_variants.VARIANT_EXTENSION}"
+                for name in image_variants.VARIANT_WIDTHS
+            }
+            if deduplicated:
+                for name, variant_blob in variant_blobs.items():
+                    existing = bucket.get_blob(variant_blob)
+                    metadata = (existing.metadata or {}) if existing else {}
+                    if "width" in metadata and "height" in metadata:
+                        variants[name] = {
+                            "url": self._sign(bucket, variant_blob),
+                            "width": int(metadata["width"]),
+                            "height": int(metadata["height"])
+                        }
+            if len(variants) < len(variant_blobs):
+                file_content.seek(0)
+                rendered = image_variants.create_variants(file_content)
+                for name, (data, width, height) in rendered.items():
+                    if name in variants:
+                        continue
+                    try:
+                        blob = bucket.blob(variant_blobs[name])
+                        blob.metadata = {"width": str(width), "height": str(height)}
+                        blob.upload_from_string(data, content_type=image_variants.VARIANT_CONTENT_TYPE)
+                        variants[name] = {"url": self._sign(bucket, variant_blobs[name]), "width": width, "height": height}
+                    except Exception as e:
+                        print(f"⚠ Could not upload {name} variant of {filename}: {e}")
+        return {
+            "image_url": image_url,
+            "content_hash": content_hash,
+            "deduplicated": deduplicated,
+            "variants": variants
+        }
+    
+    @staticmethod
+    def direct_upload_prefix(product_id: str) -> str:
+        """Blob prefix browsers may upload to directly for a product"""
+        return f"product_images/direct/{product_id}/"
+    
+    def create_upload_url(self, product_id: str, filename: str, content_type: str) -> Optional[Dict[str, Any]]:
+        """Issue a V4 signed PUT URL so a browser can upload one image straight to the bucket
+        
+        The upload must be sent with the returned headers: the Content-Type is
+        part of the signature and x-goog-content-length-range makes the bucket
+        reject bodies over UPLOAD_MAX_BYTES.
+        
+        Returns:
+            {"blob_name", "upload_url", "headers", "expires_at"}, or None if storage is not configured
+        """
+        bucket = self.bucket
+        if not bucket:
+            return None
+        safe_filename = "".join(c if c.isalnum() or c in ('-', '_', '.') else '_' for c in filename)[-100:]
+        blob_name = f"{self.direct_upload_prefix(product_id)}{uuid.uuid4()}_{safe_filename}"
+        headers = {"x-goog-content-length-range": f"0,{UPLOAD_MAX_BYTES}"}
+        upload_url = bucket.blob(blob_name).generate_signed_url(
+            version="v4",
+            expiration=DIRECT_UPLOAD_URL_EXPIRATION,
+            method="PUT",
+            content_type=content_type,
+            headers=headers
+        )
+        return {
+            "blob_name": blob_name,
+            "upload_url": upload_url,
+            "headers": {"Content-Type": content_type, **headers},
+            "expires_at": datetime.now(timezone.utc) + DIRECT_UPLOAD_URL_EXPIRATION
+        }
+    
+    def finalize_upload(self, product_id: str, blob_name: str) -> str:
+        """Check a direct upload landed where it was allowed to and return its signed GET URL
+        
+        Only the blob's metadata is read, never its bytes. Raises ValueError if
+        the blob is outside the product's upload prefix, missing, not an
+        image or over UPLOAD_MAX_BYTES (oversized blobs are deleted).
+        """
+        bucket = self.bucket
+        if not bucket:
+            raise ValueError("Firebase Storage not configured (set FIREBASE_STORAGE_BUCKET)")
+        if not blob_name.startswith(self.direct_upload_prefix(product_id)) or ".." in blob_name:
+            raise ValueError("Upload does not belong to this product")
+        blob = bucket.get_blob(blob_name)
+        if blob is None:
+            raise ValueError("Upload not found - the PUT did not complete")
+        if not (blob.content_type or "").startswith("image/"):
+            raise ValueError(f"Not an image ({blob.content_type})")
+        if blob.size is not None and blob.size > UPLOAD_MAX_BYTES:
+            blob.delete()
+            raise ValueError(f"Upload is larger than {UPLOAD_MAX_BYTES} bytes")
+        return self._sign(bucket, blob_name)
+    
+    def _blob_name_from_url(self, file_url: str) -> Optional[str]:
+        """Extract the blob path from a storage.googleapis.com or firebasestorage.googleapis.com URL"""
+        import urllib.parse
+        
+        # Check if it's a storage.googleapis.com URL
+        if f"{self.bucket_name}/" in file_url:
+            # Extract from storage.googleapis.com URL
+            parts = file_url.split(f"{self.bucket_name}/")
+            if len(parts) > 1:
+                return urllib.parse.unquote(parts[1].split("?")[0])  # Remove query params and decode
+        # Check if it's a firebasestorage.googleapis.com URL
+        elif "firebasestorage.googleapis.com" in file_url:
+            # Extract from Firebase Storage URL format: /v0/b/BUCKET/o/PATH?alt=media
+            if "/o/" in file_url:
+                parts = file_url.split("/o/")
+                if len(parts) > 1:
+                    encoded_path = parts[1].split("?")[0]
+                    return urllib.parse.unquote(encoded_path)
+        # Check if it's a signed URL with the blob path in it
+        elif "storage.googleapis.com" in file_url:
+            # Find the path after the bucket name
+            if self.bucket_name and self.bucket_name in file_url:
+                parts = file_url.split(self.bucket_name)
+                if len(parts) > 1:
+                    path_part = parts[1].split("?")[0]
+                    if path_part.startswith("/"):
+                        return urllib.parse.unquote(path_part[1:])  # Remove leading /
+        return None
+    
+    @staticmethod
+    def _signed_url_expiry(signed_url: str) -> Optional[float]:
+        """Expiry (epoch seconds) encoded in a V2 (Expires=) or V4 (X-Goog-Date + X-Goog-Expires) signed URL"""
+        import urllib.parse
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(signed_url).query)
+        try:
+            if "Expires" in query:
+                return float(query["Expires"][0])
+            if "X-Goog-Date" in query and "X-Goog-Expires" in query:
+                signed_at = datetime.strptime(query["X-Goog-Date"][0], "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+                return signed_at.timestamp() + float(query["X-Goog-Expires"][0])
+        except (ValueError, IndexError):
+            pass
+        return None
+    
+    def _cached_signed_url(self, blob_name: str) -> Optional[str]:
+        with self._signed_url_lock:
+            entry = self._signed_urls.get(blob_name)
+            if entry is None:
+                return None
+            signed_url, expires_at = entry
+            if expires_at - time.time() < SIGNED_URL_REFRESH_MARGIN.total_seconds():
+                del self._signed_urls[blob_name]
+                return None
+            self._signed_urls.move_to_end(blob_name)
+            return signed_url
+    
+    def _remember_signed_url(self, blob_name: str, signed_url: str, expires_at: float) -> None:
+        with self._signed_url_lock:
+            self._signed_urls[blob_name] = (signed_url, expires_at)
+            self._signed_urls.move_to_end(blob_name)
+            while len(self._signed_urls) > self.signed_url_cache_size:
+                self._signed_urls.popitem(last=False)
+    
+    def _sign(self, bucket, blob_name: str) -> str:
+        """Sign a GET URL for a blob, reusing a cached one until it nears expiry"""
+        cached = self._cached_signed_url(blob_name)
+        if cached is not None:
+            return cached
+        signed_url = bucket.blob(blob_name).generate_signed_url(
+            expiration=SIGNED_URL_EXPIRATION,
+            method='GET'
+        )
+        self._remember_signed_url(blob_name, signed_url, time.time() + SIGNED_URL_EXPIRATION.total_seconds())
+        return signed_url
+    
     def get_signed_url(self, file_url: str) -> Optional[str]:
         """Convert a storage URL to a signed URL if needed
         
+        Signed URLs are cached per blob (LRU) and only re-signed when they are
+        within SIGNED_URL_REFRESH_MARGIN of expiring, so repeat views do no
+        signing at all. An already-signed URL is returned as-is unless it is
+        about to expire.
+        
         Args:
             file_url: Existing file URL (can be direct URL or signed URL)
         
         Returns:
-            Signed URL valid for 10 years, or original URL if conversion fails
+            Signed URL, or original URL if conversion fails
         """
-        # If URL already contains a signature (signed URL), return as-is
+        # If URL already contains a signature (signed URL), return as-is while it's still valid
         if "Signature=" in file_url or "X-Goog-Signature" in file_url:
-            return file_url
+            expires_at = self._signed_url_expiry(file_url)
+            if expires_at is None or expires_at - time.time() >= SIGNED_URL_REFRESH_MARGIN.total_seconds():
+                return file_url
         
         bucket = self.bucket
         if not bucket:
             return file_url
         
         try:
-            # Extract blob path from URL
-            blob_name = None
-            import urllib.parse
-            
-            # Check if it's a storage.googleapis.com URL
-            if f"{self.bucket_name}/" in file_url:
-                # Extract from storage.googleapis.com URL
-                parts = file_url.split(f"{self.bucket_name}/")
-                if len(parts) > 1:
-                    blob_name = urllib.parse.unquote(parts[1].split("?")[0])  # Remove query params and decode
-            # Check if it's a firebasestorage.googleapis.com URL
-            elif "firebasestorage.googleapis.com" in file_url:
-                # Extract from Firebase Storage URL format: /v0/b/BUCKET/o/PATH?alt=media
-                if "/o/" in file_url:
-                    parts = file_url.split("/o/")
-                    if len(parts) > 1:
-                        encoded_path = parts[1].split("?")[0]
-                        blob_name = urllib.parse.unquote(encoded_path)
-            # Check if it's a signed URL with the blob path in it
-            elif "storage.googleapis.com" in file_url:
-                # Try to extract from any storage.googleapis.com URL
-                if "/" in file_url:
-                    # Find the path after the bucket name
-                    if self.bucket_name in file_url:
-                        parts = file_url.split(self.bucket_name)
-                        if len(parts) > 1:
-                            path_part = parts[1].split("?")[0]
-                            if path_part.startswith("/"):
-                                blob_name = urllib.parse.unquote(path_part[1:])  # Remove leading /
-            
+            blob_name = self._blob_name_from_url(file_url)
             if blob_name:
-                blob = bucket.blob(blob_name)
-                signed_url = blob.generate_signed_url(
-                    expiration=timedelta(days=3650),
-                    method='GET'
-                )
-                print(f"Debug: Generated signed URL for: {blob_name[:50]}...")
-                return signed_url
-            else:
-                print(f"Debug: Could not extract blob name from URL: {file_url[:80]}...")
+                return self._sign(bucket, blob_name)
+            print(f"Debug: Could not extract blob name from URL: {file_url[:80]}...")
         except Exception as e:
             print(f"Debug: Could not generate signed URL for {file_url[:80]}...: {e}")
             import traceback
@@ -168,6 +461,14 @@ class FirebaseStorage:
         
         return file_url  # Return original URL if conversion fails
     
+    def get_signed_urls(self, file_urls: list) -> list:
+        """get_signed_url() for a gallery: each distinct URL is resolved once, results in input order"""
+        resolved = {}
+        for file_url in file_urls:
+            if file_url and file_url not in resolved:
+                resolved[file_url] = self.get_signed_url(file_url)
+        return [resolved.get(file_url, file_url) for file_url in file_urls]
+    
     def delete_file(self, file_url: str) -> bool:
         """Delete file from Firebase Storage by URL"""
         bucket = self.bucket  # This will trigger lazy initialization
@@ -191,4 +492,44 @@ class FirebaseStorage:
             print(f"Error deleting from Firebase Storage: {e}")
             return False
 
+    def delete_image(self, image_data: Dict[str, Any], still_unused: Optional[Callable[[], bool]] = None) -> None:
+        """Delete a product image's original and all of its derivatives
+        
+        With still_unused, the blobs' generations are read first, still_unused()
+        is checked, and each delete only succeeds if the blob was not rewritten
+        since - so an upload that re-claimed the content meanwhile keeps it.
+        """
+        if still_unused is not None:
+            self._delete_unless_rewritten(image_data, still_unused)
+            return
+        if image_data.get("image_url"):
+            self.delete_file(image_data["image_url"])
+        for variant in (image_data.get("variants") or {}).values():
+            if variant.get("url"):
+                self.delete_file(variant["url"])
+
+    
+    def _delete_unless_rewritten(self, image_data: Dict[str, Any], still_unused: Callable[[], bool]) -> None:
+        bucket = self.bucket
+        if not bucket:
+            return
+        urls = [image_data.get("image_url")] + [
+            variant.get("url") for variant in (image_data.get("variants") or {}).values()
+        ]
+        blobs = []
+        for url in urls:
+            blob_name = self._blob_name_from_url(url) if url else None
+            blob = bucket.get_blob(blob_name) if blob_name else None
+            if blob is not None:
+                blobs.append(blob)
+        if not blobs or not still_unused():
+            return
+        for blob in blobs:
+            try:
+                blob.delete(if_generation_match=blob.generation)
+            except (PreconditionFailed, NotFound):
+                pass  # Rewritten by a new upload, or already gone
+            except Exception as e:
+                print(f"⚠ Could not delete {blob.name}: {e}")
+
 storage_client = FirebaseStorage()
@@ -0,0 +1,102 @@
+from typing import Iterable, Optional
+from google.api_core.exceptions import NotFound, AlreadyExists
+from firebase_admin import firestore
+
+# Every supplier name used on a purchase lives in one document:
+#   indexes/suppliers = {"suppliers": {name: {"count": int, "last_used": timestamp}}}
+# so the purchase form and typeahead cost a single read.
+SUPPLIER_INDEX_DOC = ("indexes", "suppliers")
+
+
+def _index_ref(db):
+    return db.collection(SUPPLIER_INDEX_DOC[0]).document(SUPPLIER_INDEX_DOC[1])
+
+
+def _field(name: str, key: str) -> str:
+    return firestore.FieldPath("suppliers", name, key).to_api_repr()
+
+
+def record_supplier_changes(db, changes: Iterable[tuple]) -> None:
+    """Adjust supplier usage for purchase writes given as (old_supplier, new_supplier) pairs
+
+    Either side may be None (create/delete). Like the counters, uses update()
+    so an index that was never seeded stays missing and is built from the
+    purchases on first read instead of starting from a wrong baseline.
+    """
+    updates = {}
+    for old_name, new_name in changes:
+        if old_name == new_name:
+            continue
+        if old_name:
+            path = _field(old_name, "count")
+            updates[path] = updates.get(path, 0) - 1
+        if new_name:
+            path = _field(new_name, "count")
+            updates[path] = updates.get(path, 0) + 1
+            updates[_field(new_name, "last_used")] = firestore.SERVER_TIMESTAMP
+    payload = {
+        path: firestore.Increment(value) if isinstance(value, int) else value
+        for path, value in updates.items()
+        if value != 0
+    }
+    if not payload:
+        return
+    try:
+        _index_ref(db).update(payload)
+    except NotFound:
+        pass  # Not seeded yet - the next load_suppliers() builds it
+    except Exception as e:
+        print(f"⚠ Could not update supplier index: {e}")
+
+
+def record_supplier_change(db, old_name: Optional[str], new_name: Optional[str]) -> None:
+    record_supplier_changes(db, [(old_name, new_name)])
+
+
+def _build_index(db) -> dict:
+    suppliers = {}
+    for purchase_doc in db.collection("purchases").stream():
+        purchase = purchase_doc.to_dict()
+        name = purchase.get("supplier_name") if purchase else None
+        if not name:
+            continue
+        entry = suppliers.setdefault(name, {"count": 0, "last_used": None})
+        entry["count"] += 1
+        created_at = purchase.get("created_at")
+        if created_at and (entry["last_used"] is None or created_at > entry["last_used"]):
+            entry["last_used"] = created_at
+    return suppliers
+
+
+def load_suppliers(db) -> list:
+    """All suppliers still used by a purchase: [{"name", "count", "last_used"}], sorted by name"""
+    index_ref = _index_ref(db)
+    index = index_ref.get()
+    if index.exists:
+        suppliers = (index.to_dict() or {}).get("suppliers") or {}
+    else:
+        # First use: build the index from the existing purchases
+        suppliers = _build_index(db)
+        try:
+            index_ref.create({"suppliers": suppliers})
+        except AlreadyExists:
+            pass
+        except Exception as e:
+            print(f"⚠ Could not seed supplier index: {e}")
+    return sorted(
+        (
+            {"name": name, "count": int(entry.get("count", 0)), "last_used": entry.get("last_used")}
+            for name, entry in suppliers.items()
+            if entry.get("count", 0) > 0
+        ),
+        key=lambda s: s["name"]
+    )
+
+
+def search_suppliers(db, prefix: str, limit: int = 10) -> list:
+    """Suppliers whose name starts with prefix (case-insensitive), most used and most recent first"""
+    prefix = prefix.strip().casefold()
+    matches = [s for s in load_suppliers(db) if s["name"].casefold().startswith(prefix)]
+    matches.sort(key=lambda s: s["last_used"].timestamp() if hasattr(s["last_used"], "timestamp") else 0, reverse=True)
+    matches.sort(key=lambda s: s["count"], reverse=True)
+    return matches[:limit]